@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+import re
+from pathlib import Path
+from typing import Callable
+
+_SECTION_SPLIT_RE = re.compile(r"(\n\s*#\s*\w+\n)")
+
+
+def split_sections(s: str) -> list[str]:
+    """Одно линейное разбиение текста по маркерам секций ("# name").
+
+    Возвращает список [преамбула, заголовок1, тело1, заголовок2, тело2, ...];
+    "".join(...) собирает текст обратно без потерь.
+    """
+    return _SECTION_SPLIT_RE.split(s)
+
+
+def edit(path: Path, *passes: Callable[[str], str], encoding: str = "utf-8") -> bool:
+    """Читает файл один раз, прогоняет все трансформации в памяти, пишет один раз.
+
+    Возвращает True если файл изменился.
+    """
+    orig = path.read_text(encoding, errors="replace")
+    s = orig
+    for f in passes:
+        s = f(s)
+    if s == orig:
+        return False
+    path.write_text(s, encoding)
+    return True
@@ -1,8 +1,14 @@
 from __future__ import annotations
 
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+_ASYNC_SESSION_IMPORT_RE = re.compile(r"from sqlalchemy\.ext\.asyncio import AsyncSession\s*\n")
+_INSERT_POINT_RE = re.compile(r"\n\nasync def _get_table_columns")
+_ENSURE_IMPORT_RE = re.compile(r"\bfrom\s+vestnik\.schema\s+import\s+ensure_schema\b")
+_ENSURE_CALL_RE = re.compile(r"\bawait\s+ensure_schema\(\s*session\s*\)")
+
 def patch_schema_py() -> None:
     p = Path("src/vestnik/schema.py")
     s = p.read_text(encoding="utf-8")
@@ -13,14 +19,14 @@ def patch_schema_py() -> None:
 
     if "from vestnik.settings import env_bool" not in s:
         # вставим после AsyncSession импорта
-        m = re.search(r"from sqlalchemy\.ext\.asyncio import AsyncSession\s*\n", s)
+        m = _ASYNC_SESSION_IMPORT_RE.search(s)
         if not m:
             raise SystemExit("cannot locate AsyncSession import in schema.py")
         ins_at = m.end()
         s = s[:ins_at] + "from vestnik.settings import env_bool\n\n" + s[ins_at:]
 
     # вставим helper сразу после импортов (после блока import...)
-    m2 = re.search(r"\n\nasync def _get_table_columns", s)
+    m2 = _INSERT_POINT_RE.search(s)
     if not m2:
         raise SystemExit("cannot locate insertion point in schema.py")
     helper = (
@@ -39,6 +45,27 @@ def patch_schema_py() -> None:
     p.write_text(s, encoding="utf-8")
     print("patched:", p)
 
+def _patch_one_callsite(p: Path) -> None:
+    if not p.exists():
+        print("skip: missing", p)
+        return
+    s = p.read_text(encoding="utf-8")
+
+    s2 = s
+
+    # import
+    s2 = _ENSURE_IMPORT_RE.sub("from vestnik.schema import maybe_ensure_schema", s2)
+
+    # await call
+    s2 = _ENSURE_CALL_RE.sub("await maybe_ensure_schema(session)", s2)
+
+    if s2 != s:
+        p.write_text(s2, encoding="utf-8")
+        print("patched:", p)
+    else:
+        print("no changes:", p)
+
+
 def patch_callsites() -> None:
     targets = [
         Path("src/vestnik/worker/__main__.py"),
@@ -46,33 +73,10 @@ def patch_callsites() -> None:
         Path("src/vestnik/harvester/__main__.py"),
         Path("src/vestnik/brain/pipeline.py"),
     ]
-    for p in targets:
-        if not p.exists():
-            print("skip: missing", p)
-            continue
-        s = p.read_text(encoding="utf-8")
-
-        s2 = s
-
-        # import
-        s2 = re.sub(
-            r"\bfrom\s+vestnik\.schema\s+import\s+ensure_schema\b",
-            "from vestnik.schema import maybe_ensure_schema",
-            s2,
-        )
-
-        # await call
-        s2 = re.sub(
-            r"\bawait\s+ensure_schema\(\s*session\s*\)",
-            "await maybe_ensure_schema(session)",
-            s2,
-        )
-
-        if s2 != s:
-            p.write_text(s2, encoding="utf-8")
-            print("patched:", p)
-        else:
-            print("no changes:", p)
+    # Файлы независимы: читаем/патчим/пишем их параллельно, потоки
+    # перекрывают I/O-ожидания.
+    with ThreadPoolExecutor(max_workers=len(targets)) as ex:
+        list(ex.map(_patch_one_callsite, targets))
 
 patch_schema_py()
 patch_callsites()
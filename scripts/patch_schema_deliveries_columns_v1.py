@@ -2,12 +2,15 @@ from pathlib import Path
 import re
 import sys
 
+_SEC_PAT = re.compile(r"(\n\s*# deliveries\n)(.*?)(\n\s*# user_settings\n)", re.S)
+_ENTRY_PAT = re.compile(r'("deliveries"\s*:\s*\[)([^\]]*)(\])', re.S)
+_POSTS_CACHE_ENTRY_PAT = re.compile(r'("posts_cache"\s*:\s*\[[^\]]*\]\s*,\s*\n)')
+
 p = Path("src/vestnik/schema.py")
 s = p.read_text("utf-8", errors="replace")
 
 # --- Patch ensure_schema deliveries section ---
-sec_pat = re.compile(r"(\n\s*# deliveries\n)(.*?)(\n\s*# user_settings\n)", re.S)
-m = sec_pat.search(s)
+m = _SEC_PAT.search(s)
 if not m:
     print("ERROR: deliveries section not found", file=sys.stderr)
     sys.exit(2)
@@ -47,8 +50,7 @@ s2 = s[:m.start()] + new_section + s[m.end():]
 # Find required_cols dict. We'll add/merge deliveries entry.
 if '"deliveries"' not in s2:
     # Add a new entry near posts_cache for readability: after posts_cache entry.
-    ins_pat = re.compile(r'("posts_cache"\s*:\s*\[[^\]]*\]\s*,\s*\n)')
-    m3 = ins_pat.search(s2)
+    m3 = _POSTS_CACHE_ENTRY_PAT.search(s2)
     if not m3:
         print("ERROR: cannot find insertion point near posts_cache in required_cols", file=sys.stderr)
         sys.exit(2)
@@ -56,8 +58,7 @@ if '"deliveries"' not in s2:
     s2 = s2[:m3.start(1)] + insert + s2[m3.end(1):]
 else:
     # Update existing deliveries entry (if exists) to include pack_id at least.
-    entry_pat = re.compile(r'("deliveries"\s*:\s*\[)([^\]]*)(\])', re.S)
-    m4 = entry_pat.search(s2)
+    m4 = _ENTRY_PAT.search(s2)
     if m4:
         inside = m4.group(2)
         needed = ["user_id", "pack_id", "channel_id", "post_id", "status", "error", "created_at"]
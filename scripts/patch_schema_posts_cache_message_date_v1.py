@@ -2,50 +2,62 @@ from pathlib import Path
 import re
 import sys
 
-p = Path("src/vestnik/schema.py")
-s = p.read_text("utf-8", errors="replace")
-
-# --- 1) ensure_schema: добавить ensure_column для message_date/message_text/created_at в posts_cache секции ---
-sec_pat = re.compile(r"(\n\s*# posts_cache\n)(.*?)(\n\s*# deliveries\n)", re.S)
-m = sec_pat.search(s)
-if not m:
-    print("ERROR: posts_cache section not found", file=sys.stderr)
-    sys.exit(2)
-
-head, body, tail = m.group(1), m.group(2), m.group(3)
-
-need_lines = [
-    '    await _ensure_column(session, posts_cache_cols, "posts_cache", "message_date", "alter table posts_cache add column message_date timestamptz;")',
-    '    await _ensure_column(session, posts_cache_cols, "posts_cache", "message_text", "alter table posts_cache add column message_text text;")',
-    '    await _ensure_column(session, posts_cache_cols, "posts_cache", "created_at", "alter table posts_cache add column created_at timestamptz;")',
-]
-
-if not all(line in body for line in need_lines):
-    anchor = 'await _ensure_column(session, posts_cache_cols, "posts_cache", "message_id_int", "alter table posts_cache add column message_id_int bigint;")'
-    if anchor not in body:
-        print("ERROR: anchor ensure_column message_id_int not found in posts_cache section", file=sys.stderr)
+from _patchlib import edit, split_sections
+
+_ENTRY_PAT = re.compile(r'("posts_cache"\s*:\s*\[)([^\]]*)(\])', re.S)
+_NEEDED_COLS = {"message_date", "message_text", "created_at"}
+_NEEDED_RE = re.compile(
+    r'_ensure_column\(session, posts_cache_cols, "posts_cache", "(message_date|message_text|created_at)"'
+)
+
+
+def _pass_ensure_schema(s: str) -> str:
+    # --- 1) ensure_schema: добавить ensure_column для message_date/message_text/created_at в posts_cache секции ---
+    # Один линейный split по "# section" вместо отдельного полнотекстового regex-поиска секции.
+    parts = split_sections(s)
+    sec_i = next((i for i in range(1, len(parts), 2) if parts[i].strip() == "# posts_cache"), None)
+    if sec_i is None or sec_i + 1 >= len(parts):
+        print("ERROR: posts_cache section not found", file=sys.stderr)
         sys.exit(2)
 
-    insert = anchor + "\n" + "\n".join(need_lines)
-    body = body.replace(anchor, insert, 1)
+    body = parts[sec_i + 1]
 
-new_section = head + body + tail
-s2 = s[:m.start()] + new_section + s[m.end():]
+    need_lines = [
+        '    await _ensure_column(session, posts_cache_cols, "posts_cache", "message_date", "alter table posts_cache add column message_date timestamptz;")',
+        '    await _ensure_column(session, posts_cache_cols, "posts_cache", "message_text", "alter table posts_cache add column message_text text;")',
+        '    await _ensure_column(session, posts_cache_cols, "posts_cache", "created_at", "alter table posts_cache add column created_at timestamptz;")',
+    ]
 
-# --- 2) check_schema: добавить message_date в required_cols["posts_cache"] ---
-# Ищем entry "posts_cache": [...]
-entry_pat = re.compile(r'("posts_cache"\s*:\s*\[)([^\]]*)(\])', re.S)
-m2 = entry_pat.search(s2)
-if not m2:
-    print('ERROR: required_cols["posts_cache"] entry not found', file=sys.stderr)
-    sys.exit(2)
+    # Один regex-проход по секции вместо трёх substring-сканов.
+    if set(_NEEDED_RE.findall(body)) != _NEEDED_COLS:
+        anchor = 'await _ensure_column(session, posts_cache_cols, "posts_cache", "message_id_int", "alter table posts_cache add column message_id_int bigint;")'
+        if anchor not in body:
+            print("ERROR: anchor ensure_column message_id_int not found in posts_cache section", file=sys.stderr)
+            sys.exit(2)
 
-inside = m2.group(2)
-if "message_date" not in inside:
+        insert = anchor + "\n" + "\n".join(need_lines)
+        body = body.replace(anchor, insert, 1)
+
+    parts[sec_i + 1] = body
+    return "".join(parts)
+
+
+def _pass_check_schema(s: str) -> str:
+    # --- 2) check_schema: добавить message_date в required_cols["posts_cache"] ---
+    # Ищем entry "posts_cache": [...]
+    m2 = _ENTRY_PAT.search(s)
+    if not m2:
+        print('ERROR: required_cols["posts_cache"] entry not found', file=sys.stderr)
+        sys.exit(2)
+
+    inside = m2.group(2)
+    if "message_date" in inside:
+        return s
     items = [x.strip() for x in inside.split(",") if x.strip()]
     items.append('"message_date"')
     new_inside = ", ".join(items)
-    s2 = s2[:m2.start(2)] + new_inside + s2[m2.end(2):]
+    return s[: m2.start(2)] + new_inside + s[m2.end(2) :]
+
 
-p.write_text(s2, "utf-8")
+edit(Path("src/vestnik/schema.py"), _pass_ensure_schema, _pass_check_schema)
 print("OK: patched src/vestnik/schema.py")
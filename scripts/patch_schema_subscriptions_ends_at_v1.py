@@ -2,12 +2,16 @@ from pathlib import Path
 import re
 import sys
 
+_SEC_PAT = re.compile(r"(\n\s*# subscriptions\n)(.*?)(\n\s*# packs\n)", re.S)
+_ENTRY_PAT = re.compile(r'("subscriptions"\s*:\s*\[)([^\]]*)(\])', re.S)
+_DELIVERIES_ENTRY_PAT = re.compile(r'("deliveries"\s*:\s*\[[^\]]*\]\s*,\s*\n)')
+_POSTS_CACHE_ENTRY_PAT = re.compile(r'("posts_cache"\s*:\s*\[[^\]]*\]\s*,\s*\n)')
+
 p = Path("src/vestnik/schema.py")
 s = p.read_text("utf-8", errors="replace")
 
 # --- 1) ensure_schema: subscriptions section ---
-sec_pat = re.compile(r"(\n\s*# subscriptions\n)(.*?)(\n\s*# packs\n)", re.S)
-m = sec_pat.search(s)
+m = _SEC_PAT.search(s)
 if not m:
     print("ERROR: subscriptions section not found", file=sys.stderr)
     sys.exit(2)
@@ -39,18 +43,15 @@ new_section = head + body + tail
 s2 = s[:m.start()] + new_section + s[m.end():]
 
 # --- 2) check_schema: required_cols add/update subscriptions ---
-entry_pat = re.compile(r'("subscriptions"\s*:\s*\[)([^\]]*)(\])', re.S)
-m2 = entry_pat.search(s2)
+m2 = _ENTRY_PAT.search(s2)
 
 needed = ["user_id", "starts_at", "ends_at", "status", "created_at"]
 
 if not m2:
     # Insert near "deliveries" entry if exists, else near posts_cache.
-    ins_pat = re.compile(r'("deliveries"\s*:\s*\[[^\]]*\]\s*,\s*\n)')
-    m3 = ins_pat.search(s2)
+    m3 = _DELIVERIES_ENTRY_PAT.search(s2)
     if not m3:
-        ins_pat = re.compile(r'("posts_cache"\s*:\s*\[[^\]]*\]\s*,\s*\n)')
-        m3 = ins_pat.search(s2)
+        m3 = _POSTS_CACHE_ENTRY_PAT.search(s2)
     if not m3:
         print("ERROR: cannot find insertion point for subscriptions in required_cols", file=sys.stderr)
         sys.exit(2)
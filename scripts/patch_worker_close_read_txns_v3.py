@@ -7,6 +7,8 @@ import sys
 
 TARGET = Path("src/vestnik/worker/__main__.py")
 
+_RETURN_RE = re.compile(r"^(\s*)return\b(.*)$")
+
 TARGET_FUNCS = [
     "_list_tables",
     "_table_cols",
@@ -33,71 +35,60 @@ def _block_end(lines: list[str], start_i: int) -> int:
     return len(lines)
 
 def patch_text(text: str) -> tuple[str, bool]:
-    src_lines_nl = text.splitlines(keepends=True)
-    plain = [l.rstrip("\n") for l in src_lines_nl]
-    out = list(src_lines_nl)
+    out = text.splitlines(keepends=True)
     changed = False
 
     for fname in TARGET_FUNCS:
-        si = _find_async_def(plain, fname)
+        si = _find_async_def(out, fname)
         if si is None:
             continue
-        ei = _block_end(plain, si)
+        ei = _block_end(out, si)
 
         first_exec = None
         for j in range(si, ei):
-            if "await session.execute" in plain[j]:
+            if "await session.execute" in out[j]:
                 first_exec = j
                 break
         if first_exec is None:
             continue
 
-        j = si
-        while j < ei:
-            if j <= first_exec:
-                j += 1
-                continue
-
-            m = re.match(r"^(\s*)return\b(.*)$", plain[j])
-            if not m:
-                j += 1
+        # Single streaming pass over the block: append into a fresh buffer,
+        # never shifting earlier indices (list.insert is O(n) per call).
+        result: list[str] = []
+        last_code = ""  # last non-empty line appended, for the commit/rollback skip
+        block_changed = False
+
+        for idx in range(si, ei):
+            line = out[idx]
+            m = _RETURN_RE.match(line) if idx > first_exec else None
+            if not m or last_code in ("await session.commit()", "await session.rollback()"):
+                result.append(line)
+                if line.strip():
+                    last_code = line.strip()
                 continue
 
             indent = m.group(1)
-
-            # if previous non-empty line already commits/rollbacks — skip
-            k = j - 1
-            while k >= si and plain[k].strip() == "":
-                k -= 1
-            if k >= si and plain[k].strip() in ("await session.commit()", "await session.rollback()"):
-                j += 1
-                continue
-
-            line = plain[j].strip()
-            expr = line[len("return "):].strip()
+            expr = line.strip()[len("return "):].strip()
 
             # If return expression consumes `res.*` directly — materialize first, then commit, then return
-            if "res." in plain[j]:
+            if "res." in line:
                 tmp = f"__ret_{fname.strip('_')}"
-                new = [
-                    f"{indent}{tmp} = {expr}\n",
-                    f"{indent}await session.commit()\n",
-                    f"{indent}return {tmp}\n",
-                ]
-                out[j:j+1] = new
-                plain[j:j+1] = [x.rstrip("\n") for x in new]
-                delta = len(new) - 1
-                ei += delta
-                changed = True
-                j += len(new)
-                continue
-
-            # Otherwise: insert commit before return (results already materialized into local vars/out lists)
-            out.insert(j, f"{indent}await session.commit()\n")
-            plain.insert(j, f"{indent}await session.commit()")
-            ei += 1
+                result.extend(
+                    [
+                        f"{indent}{tmp} = {expr}\n",
+                        f"{indent}await session.commit()\n",
+                        f"{indent}return {tmp}\n",
+                    ]
+                )
+            else:
+                # Otherwise: insert commit before return (results already materialized into local vars/out lists)
+                result.extend([f"{indent}await session.commit()\n", line])
+            last_code = line.strip()
+            block_changed = True
+
+        if block_changed:
+            out = out[:si] + result + out[ei:]
             changed = True
-            j += 2
 
     return ("".join(out), changed)
 
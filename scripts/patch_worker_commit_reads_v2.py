@@ -1,11 +1,19 @@
 from __future__ import annotations
 
 from pathlib import Path
+import ast
 import subprocess
 import re
 import sys
 
 
+_SET_RETURN_RE = re.compile(r"^(\s*)return\s+\{r\[0\]\s+for\s+r\s+in\s+res\.all\(\)\}\s*$", re.M)
+_LIST_RETURN_RE = re.compile(r"^(\s*)return\s+\[int\(r\[0\]\)\s+for\s+r\s+in\s+res\.all\(\)\]\s*$", re.M)
+_OUT_RETURN_RE = re.compile(r"^(\s*)return\s+out\s*$", re.M)
+_COMMIT_RETURN_RE = re.compile(r"await session\.commit\(\)\s*\n\s*return\b")
+_COMMIT_CALL_RE = re.compile(r"^await session\.(commit|rollback)\(\)\s*$")
+
+
 def repo_root() -> Path:
     return Path(subprocess.check_output(["git", "rev-parse", "--show-toplevel"], text=True).strip())
 
@@ -30,26 +38,49 @@ def replace_block(s: str, name: str, new_seg: str) -> str:
     return s[:i] + new_seg + s[j:]
 
 
-def ensure_commit_before_returns(seg: str) -> str:
-    lines = seg.splitlines(True)
-    out: list[str] = []
-    for idx, line in enumerate(lines):
-        m = re.match(r"^(\s*)return\b", line)
-        if not m:
-            out.append(line)
+def _top_scope_stmts(stmts: list[ast.stmt]):
+    # Statements of the function body including if/try/else branches,
+    # but NOT bodies of nested def/async def/class.
+    for st in stmts:
+        yield st
+        if isinstance(st, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
             continue
-        indent = m.group(1)
-        # find previous non-empty line in out
-        k = len(out) - 1
-        while k >= 0 and out[k].strip() == "":
+        for field in ("body", "orelse", "finalbody"):
+            sub = getattr(st, field, None)
+            if sub:
+                yield from _top_scope_stmts(sub)
+        for h in getattr(st, "handlers", None) or []:
+            yield from _top_scope_stmts(h.body)
+
+
+def ensure_commit_before_returns(s: str, name: str) -> str:
+    # AST, not regex: 'return' inside strings, lambdas or nested defs is ignored,
+    # and we edit by (lineno, col_offset) instead of scanning lines.
+    tree = ast.parse(s)
+    fn = next(
+        (n for n in tree.body if isinstance(n, (ast.AsyncFunctionDef, ast.FunctionDef)) and n.name == name),
+        None,
+    )
+    if fn is None:
+        return s
+
+    returns = [st for st in _top_scope_stmts(fn.body) if isinstance(st, ast.Return)]
+    if not returns:
+        return s
+
+    lines = s.splitlines(True)
+    # Descending so earlier insert positions stay valid.
+    for st in sorted(returns, key=lambda n: n.lineno, reverse=True):
+        i = st.lineno - 1
+        k = i - 1
+        while k >= 0 and lines[k].strip() == "":
             k -= 1
-        prev = out[k] if k >= 0 else ""
-        if re.match(rf"^{re.escape(indent)}await session\.(commit|rollback)\(\)\s*$", prev.strip()):
-            out.append(line)
+        prev = lines[k].strip() if k >= 0 else ""
+        if _COMMIT_CALL_RE.match(prev):
             continue
-        out.append(f"{indent}await session.commit()\n")
-        out.append(line)
-    return "".join(out)
+        indent = " " * st.col_offset
+        lines.insert(i, f"{indent}await session.commit()\n")
+    return "".join(lines)
 
 
 def main() -> int:
@@ -74,7 +105,7 @@ def main() -> int:
             continue
 
         if kind == "set":
-            pat = re.compile(r"^(\s*)return\s+\{r\[0\]\s+for\s+r\s+in\s+res\.all\(\)\}\s*$", re.M)
+            pat = _SET_RETURN_RE
             m = pat.search(seg)
             if not m:
                 continue
@@ -87,7 +118,7 @@ def main() -> int:
             )
             new_seg = pat.sub(repl, seg, count=1)
         else:
-            pat = re.compile(r"^(\s*)return\s+\[int\(r\[0\]\)\s+for\s+r\s+in\s+res\.all\(\)\]\s*$", re.M)
+            pat = _LIST_RETURN_RE
             m = pat.search(seg)
             if not m:
                 continue
@@ -115,10 +146,10 @@ def main() -> int:
         if not blk:
             continue
         i, j, seg = blk
-        if re.search(r"await session\.commit\(\)\s*\n\s*return\b", seg):
+        if _COMMIT_RETURN_RE.search(seg):
             continue
         # only patch the final 'return out' line (safe; out already materialized)
-        pat = re.compile(r"^(\s*)return\s+out\s*$", re.M)
+        pat = _OUT_RETURN_RE
         if not pat.search(seg):
             continue
         new_seg = pat.sub(r"\1await session.commit()\n\1return out", seg, count=1)
@@ -128,13 +159,9 @@ def main() -> int:
 
     # 3) Functions with multiple returns: ensure commit before EACH return (safe: return expr does not depend on live cursor)
     for fn in ["_get_user_settings", "_find_report_id"]:
-        blk = slice_block(s, fn)
-        if not blk:
-            continue
-        i, j, seg = blk
-        new_seg = ensure_commit_before_returns(seg)
-        if new_seg != seg:
-            s = s[:i] + new_seg + s[j:]
+        new_s = ensure_commit_before_returns(s, fn)
+        if new_s != s:
+            s = new_s
             changed = True
 
     if not changed:
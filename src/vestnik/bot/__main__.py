@@ -1,19 +1,29 @@
 import asyncio
+import hashlib
 import logging
 import re
+import time
 from dataclasses import dataclass
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
 
+from vestnik.settings import BOT_TOKEN
+
+# Дешёвая проверка конфига до тяжёлых импортов: без токена нет смысла
+# платить за загрузку aiogram/sqlalchemy только ради SystemExit.
+if __name__ == "__main__" and not BOT_TOKEN:
+    raise SystemExit("BOT_TOKEN is required")
+
 from aiogram import Bot, Dispatcher, F
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
-from sqlalchemy import select, text
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from vestnik.db import session_scope
 from vestnik.schema import maybe_ensure_schema
 from vestnik.models import PostCache, User
-from vestnik.settings import BOT_TOKEN
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("vestnik.bot")
@@ -21,6 +31,15 @@ logger = logging.getLogger("vestnik.bot")
 dp = Dispatcher()
 
 
+@dp.update.outer_middleware()
+async def db_session_middleware(handler, event, data):
+    # Одна сессия из пула на апдейт: хендлеры получают её через data["session"]
+    # и не платят за отдельный session_scope в каждой ветке.
+    async with session_scope() as session:
+        data["session"] = session
+        return await handler(event, data)
+
+
 @dataclass(frozen=True)
 class PackRow:
     id: int
@@ -36,31 +55,91 @@ class PostRow:
     parsed_at: datetime | None
 
 
+_IDENT_RE = re.compile(r"[a-zA-Z0-9_]+")
+
+
 def _safe_ident(name: str) -> str:
-    if not re.fullmatch(r"[a-zA-Z0-9_]+", name or ""):
+    if not _IDENT_RE.fullmatch(name or ""):
         raise ValueError(f"unsafe identifier: {name!r}")
     return name
 
 
-async def _list_tables(session) -> set[str]:
+# Горячие запросы — модульные константы: text() конструируется и
+# компилируется один раз, а asyncpg с prepared_statement_cache_size
+# переиспользует server-side prepared statement по тому же тексту.
+# Счётчик с потолком: экрану хватает "1000+", а LIMIT в подзапросе не даёт
+# count(*) пройти весь хвост непрочитанного.
+_UNSENT_COUNT_CAP = 1000
+
+_SQL_COUNT_UNSENT = text(
+    """
+    select count(*) from (
+        select 1
+        from posts_cache p
+        where p.channel_ref = any(:refs)
+          and p.is_deleted = false
+          and p.expires_at > :now
+          and not exists (
+            select 1 from deliveries d
+            where d.user_id = :uid
+              and d.channel_ref = p.channel_ref
+              and d.message_id = p.message_id
+          )
+        limit :cap
+    ) x
+    """
+)
+
+_SQL_SETTINGS_UPSERT = text(
+    """
+    insert into user_settings (user_id) values (:uid)
+    on conflict (user_id) do update set user_id = excluded.user_id
+    returning delivery_enabled, digest_interval_sec, last_sent_at, menu_chat_id, menu_message_id, pause_until, format_mode
+    """
+)
+
+
+
+# Схема в рантайме стабильна (весь DDL отрабатывает в main до поллинга) —
+# кэшируем интроспекцию без инвалидации, чтобы каждый callback не ходил
+# в information_schema (дорогие join'ы по pg_catalog) по 1-3 раза.
+_tables_cache: frozenset[str] | None = None
+_cols_cache: dict[str, frozenset[str]] = {}
+_pack_tables: tuple[str, str, str] | None = None
+_schema_cache_lock = asyncio.Lock()
+
+
+async def _list_tables(session) -> frozenset[str]:
+    global _tables_cache
+    if _tables_cache is not None:
+        return _tables_cache
+    # pg_catalog напрямую: information_schema.tables — это view с кучей join'ов.
     q = text(
-        "select table_name from information_schema.tables "
-        "where table_schema='public' and table_type='BASE TABLE'"
+        "select c.relname from pg_class c "
+        "join pg_namespace n on n.oid = c.relnamespace "
+        "where n.nspname = 'public' and c.relkind = 'r'"
     )
     res = await session.execute(q)
-    return {r[0] for r in res.all()}
+    _tables_cache = frozenset(r[0] for r in res)
+    return _tables_cache
 
 
-async def _table_cols(session, table: str) -> set[str]:
+async def _table_cols(session, table: str) -> frozenset[str]:
+    cached = _cols_cache.get(table)
+    if cached is not None:
+        return cached
     q = text(
-        "select column_name from information_schema.columns "
-        "where table_schema='public' and table_name=:t"
+        "select a.attname from pg_attribute a "
+        "where a.attrelid = to_regclass('public.' || :t) "
+        "and a.attnum > 0 and not a.attisdropped"
     )
     res = await session.execute(q, {"t": table})
-    return {r[0] for r in res.all()}
+    out = frozenset(r[0] for r in res)
+    _cols_cache[table] = out
+    return out
 
 
-def _pick_table(tables: set[str], candidates: list[str]) -> str | None:
+def _pick_table(tables: frozenset[str], candidates: list[str]) -> str | None:
     for t in candidates:
         if t in tables:
             return t
@@ -68,19 +147,192 @@ def _pick_table(tables: set[str], candidates: list[str]) -> str | None:
 
 
 async def _resolve_pack_tables(session) -> tuple[str, str, str]:
-    tables = await _list_tables(session)
-    packs_t = _pick_table(tables, ["packs", "pack"])
-    user_packs_t = _pick_table(tables, ["user_packs", "user_pack", "users_packs"])
-    pack_channels_t = _pick_table(tables, ["pack_channels", "pack_channel", "packs_channels"])
+    global _pack_tables
+    if _pack_tables is not None:
+        return _pack_tables
+    async with _schema_cache_lock:
+        if _pack_tables is not None:
+            return _pack_tables
+        tables = await _list_tables(session)
+        packs_t = _pick_table(tables, ["packs", "pack"])
+        user_packs_t = _pick_table(tables, ["user_packs", "user_pack", "users_packs"])
+        pack_channels_t = _pick_table(tables, ["pack_channels", "pack_channel", "packs_channels"])
+
+        missing = [name for name, t in [("packs", packs_t), ("user_packs", user_packs_t), ("pack_channels", pack_channels_t)] if t is None]
+        if missing:
+            raise RuntimeError(f"missing tables: {missing}. existing={sorted(tables)}")
+
+        _pack_tables = (packs_t, user_packs_t, pack_channels_t)
+    return _pack_tables
+
+
+@dataclass(frozen=True)
+class PackSchema:
+    packs_t: str
+    user_packs_t: str
+    pack_channels_t: str
+    sql_packs_and_selected: object
+    sql_selected: object
+    sql_toggle_upsert: object | None
+    sql_member_toggle: object
+    sql_channels_for_user: object
+    sql_channels_for_packs: object
+    sql_sendable: object
+
+
+_pack_schema: PackSchema | None = None
+
+
+async def _resolve_pack_schema(session) -> PackSchema:
+    # Раскладка pack-таблиц в рантайме не меняется: лесенку "какая колонка
+    # есть" проходим один раз, собираем готовые statements, дальше хендлеры
+    # только биндят параметры.
+    global _pack_schema
+    if _pack_schema is not None:
+        return _pack_schema
+    packs_t, user_packs_t, pack_channels_t = await _resolve_pack_tables(session)
+
+    # Три чтения pg_attribute независимы — параллелим их в своих сессиях
+    # (одна AsyncSession не переживает конкурентные await'ы).
+    async def _cols_part(table: str) -> frozenset[str]:
+        async with session_scope() as s:
+            return await _table_cols(s, table)
+
+    cols, up_cols, pc_cols = await asyncio.gather(
+        _cols_part(packs_t), _cols_part(user_packs_t), _cols_part(pack_channels_t)
+    )
+    async with _schema_cache_lock:
+        if _pack_schema is not None:
+            return _pack_schema
+
+        id_col = "id" if "id" in cols else None
+        if not id_col:
+            raise RuntimeError(f"packs table {packs_t!r} has no id column; cols={sorted(cols)}")
+        title_col = "title" if "title" in cols else ("name" if "name" in cols else ("slug" if "slug" in cols else id_col))
+
+        uid_col = "user_id" if "user_id" in up_cols else None
+        pid_col = "pack_id" if "pack_id" in up_cols else None
+        enabled_col = "is_enabled" if "is_enabled" in up_cols else ("enabled" if "enabled" in up_cols else None)
+        if not uid_col or not pid_col:
+            raise RuntimeError(f"user_packs table {user_packs_t!r} missing user_id/pack_id; cols={sorted(up_cols)}")
+
+        pc_pid_col = "pack_id" if "pack_id" in pc_cols else None
+        pc_cid_col = "channel_id" if "channel_id" in pc_cols else None
+        if not pc_pid_col or not pc_cid_col:
+            raise RuntimeError(f"pack_channels table {pack_channels_t!r} missing pack_id/channel_id; cols={sorted(pc_cols)}")
+
+        for ident in (packs_t, user_packs_t, pack_channels_t, id_col, title_col, uid_col, pid_col, pc_pid_col, pc_cid_col):
+            _safe_ident(ident)
+        if enabled_col:
+            _safe_ident(enabled_col)
+
+        join_on = f"up.{pid_col} = p.{id_col} and up.{uid_col} = :uid"
+        up_where = f"where {uid_col} = :uid"
+        cu_where = f"where up.{uid_col} = :uid"
+        if enabled_col:
+            join_on += f" and up.{enabled_col} = true"
+            up_where += f" and {enabled_col} = true"
+            cu_where += f" and up.{enabled_col} = true"
+        packs_where = "where p.is_active = true " if "is_active" in cols else ""
+
+        sql_toggle_upsert = None
+        if enabled_col:
+            sql_toggle_upsert = text(
+                f"insert into {user_packs_t} ({uid_col}, {pid_col}, {enabled_col}) "
+                f"values (:uid, :pid, true) "
+                f"on conflict ({uid_col}, {pid_col}) "
+                f"do update set {enabled_col} = not {user_packs_t}.{enabled_col}"
+            )
 
-    missing = [name for name, t in [("packs", packs_t), ("user_packs", user_packs_t), ("pack_channels", pack_channels_t)] if t is None]
-    if missing:
-        raise RuntimeError(f"missing tables: {missing}. existing={sorted(tables)}")
+        _pack_schema = PackSchema(
+            packs_t=packs_t,
+            user_packs_t=user_packs_t,
+            pack_channels_t=pack_channels_t,
+            sql_packs_and_selected=text(
+                f"select p.{id_col} as id, p.{title_col} as title, "
+                f"up.{pid_col} is not null as sel "
+                f"from {packs_t} p "
+                f"left join {user_packs_t} up on {join_on} "
+                f"{packs_where}order by p.{id_col}"
+            ),
+            sql_selected=text(f"select {pid_col} from {user_packs_t} {up_where}"),
+            sql_toggle_upsert=sql_toggle_upsert,
+            # Toggle без флага = членство в таблице: DELETE в CTE, INSERT
+            # только если удалять было нечего — одна атомарная команда вместо
+            # select + insert/delete с TOCTOU-зазором между ними.
+            sql_member_toggle=text(
+                f"with del as ("
+                f"  delete from {user_packs_t} "
+                f"  where {uid_col}=:uid and {pid_col}=:pid returning 1"
+                f") "
+                f"insert into {user_packs_t} ({uid_col}, {pid_col}) "
+                f"select :uid, :pid "
+                f"where not exists (select 1 from del)"
+            ),
+            sql_channels_for_user=text(
+                f"select distinct ltrim(c.username, '@') "
+                f"from {user_packs_t} up "
+                f"join {pack_channels_t} pc on pc.{pc_pid_col} = up.{pid_col} "
+                f"join channels c on c.id = pc.{pc_cid_col} "
+                f"{cu_where} and c.is_active = true"
+            ),
+            sql_channels_for_packs=text(
+                f"select distinct ltrim(c.username, '@') "
+                f"from {pack_channels_t} pc "
+                f"join channels c on c.id = pc.{pc_cid_col} "
+                f"where pc.{pc_pid_col} = any(:pids) "
+                f"and c.is_active = true"
+            ),
+            # Весь гейт "Отправить сейчас" одним statement'ом: настройки,
+            # каналы и непрочитанные посты — вместо трёх последовательных RTT.
+            # Гейт через left join даёт ровно одну строку и дефолты даже без
+            # записи в user_settings.
+            sql_sendable=text(
+                f"with gate as ("
+                f"  select coalesce(s.delivery_enabled, true) as en, "
+                f"         s.pause_until as pu, "
+                f"         coalesce(s.format_mode, 'digest') as mode "
+                f"  from (select 1) one "
+                f"  left join user_settings s on s.user_id = :uid"
+                f"), refs as ("
+                f"  select distinct ltrim(c.username, '@') as ref "
+                f"  from {user_packs_t} up "
+                f"  join {pack_channels_t} pc on pc.{pc_pid_col} = up.{pid_col} "
+                f"  join channels c on c.id = pc.{pc_cid_col} "
+                f"  {cu_where} and c.is_active = true"
+                f") "
+                f"select g.mode, p.channel_ref, p.message_id, "
+                f"       left(p.text, 600) as text, p.url, p.parsed_at "
+                f"from posts_cache p "
+                f"join refs r on r.ref = p.channel_ref "
+                f"cross join gate g "
+                f"where g.en "
+                f"  and (g.pu is null or g.pu <= :now) "
+                f"  and p.is_deleted = false "
+                f"  and p.expires_at > :now "
+                f"  and not exists ("
+                f"    select 1 from deliveries d "
+                f"    where d.user_id = :uid "
+                f"      and d.channel_ref = p.channel_ref "
+                f"      and d.message_id = p.message_id"
+                f"  ) "
+                f"order by p.parsed_at desc "
+                f"limit :lim"
+            ),
+        )
+    return _pack_schema
 
-    return packs_t, user_packs_t, pack_channels_t
+
+# DDL идемпотентен, но платить за create/alter на каждом апдейте незачем:
+# прогоняем один раз на процесс (startup в main), дальше — мгновенный return.
+_deliveries_ready = False
+_user_settings_ready = False
 
 
 async def _ensure_deliveries_table(session) -> None:
+    global _deliveries_ready
+    if _deliveries_ready:
+        return
     await session.execute(
         text(
             """
@@ -95,11 +347,18 @@ async def _ensure_deliveries_table(session) -> None:
             """
         )
     )
-    await session.execute(text("create index if not exists ix_deliveries_user_id on deliveries(user_id);"))
+    # unique (user_id, channel_ref, message_id) уже даёт btree-индекс,
+    # которым анти-join ходит по всем трём колонкам; отдельный индекс по
+    # user_id — его префикс и только дублирует запись при insert.
+    await session.execute(text("drop index if exists ix_deliveries_user_id;"))
     await session.commit()
+    _deliveries_ready = True
 
 
 async def _ensure_user_settings(session) -> None:
+    global _user_settings_ready
+    if _user_settings_ready:
+        return
     await session.execute(
         text(
             """
@@ -124,32 +383,39 @@ async def _ensure_user_settings(session) -> None:
     await session.execute(text("create index if not exists ix_user_settings_delivery_enabled on user_settings(delivery_enabled);"))
     await session.execute(text("create index if not exists ix_user_settings_pause_until on user_settings(pause_until);"))
     await session.commit()
+    _user_settings_ready = True
 
 
 async def _ensure_user_settings_row(session, user_id: int) -> None:
+    # Без собственного commit: вызывающий мутатор коммитит и вставку строки,
+    # и свой UPDATE одной транзакцией — минус round-trip на каждый вызов.
     await session.execute(
         text("insert into user_settings (user_id) values (:uid) on conflict do nothing"),
         {"uid": user_id},
     )
-    await session.commit()
+
+
+# Настройки меняются только через наши же мутаторы — короткий TTL-кэш
+# убирает SELECT на каждый рендер экрана, мутаторы инвалидируют запись.
+_SETTINGS_TTL_SEC = 30.0
+_settings_cache: dict[int, tuple[float, dict]] = {}
+
+
+def _settings_cache_invalidate(user_id: int) -> None:
+    _settings_cache.pop(int(user_id), None)
 
 
 async def _get_user_settings(session, user_id: int) -> dict:
+    hit = _settings_cache.get(user_id)
+    if hit is not None and hit[0] > time.monotonic():
+        return hit[1]
     await _ensure_user_settings(session)
-    await _ensure_user_settings_row(session, user_id)
-    row = (
-        await session.execute(
-            text(
-                """
-                select delivery_enabled, digest_interval_sec, last_sent_at, menu_chat_id, menu_message_id, pause_until, format_mode
-                from user_settings where user_id=:uid
-                """
-            ),
-            {"uid": user_id},
-        )
-    ).first()
+    # Один round-trip вместо insert+select: do update по PK — no-op,
+    # но заставляет RETURNING отдать строку и на конфликте.
+    row = (await session.execute(_SQL_SETTINGS_UPSERT, {"uid": user_id})).first()
+    await session.commit()
     if not row:
-        return {
+        out = {
             "delivery_enabled": True,
             "digest_interval_sec": None,
             "last_sent_at": None,
@@ -158,15 +424,20 @@ async def _get_user_settings(session, user_id: int) -> dict:
             "pause_until": None,
             "format_mode": "digest",
         }
-    return {
-        "delivery_enabled": bool(row[0]),
-        "digest_interval_sec": (int(row[1]) if row[1] is not None else None),
-        "last_sent_at": row[2],
-        "menu_chat_id": row[3],
-        "menu_message_id": row[4],
-        "pause_until": row[5],
-        "format_mode": (str(row[6]) if row[6] else "digest"),
-    }
+    else:
+        out = {
+            "delivery_enabled": bool(row[0]),
+            "digest_interval_sec": (int(row[1]) if row[1] is not None else None),
+            "last_sent_at": row[2],
+            "menu_chat_id": row[3],
+            "menu_message_id": row[4],
+            "pause_until": row[5],
+            "format_mode": (str(row[6]) if row[6] else "digest"),
+        }
+    if len(_settings_cache) > 10_000:
+        _settings_cache.clear()
+    _settings_cache[user_id] = (time.monotonic() + _SETTINGS_TTL_SEC, out)
+    return out
 
 
 async def _set_menu_message(session, user_id: int, chat_id: int, message_id: int) -> None:
@@ -177,29 +448,40 @@ async def _set_menu_message(session, user_id: int, chat_id: int, message_id: int
         {"c": int(chat_id), "m": int(message_id), "uid": int(user_id)},
     )
     await session.commit()
+    _settings_cache_invalidate(user_id)
 
 
 async def _toggle_delivery(session, user_id: int) -> bool:
-    cur = await _get_user_settings(session, user_id)
-    new_val = not bool(cur["delivery_enabled"])
-    await session.execute(
-        text("update user_settings set delivery_enabled=:v where user_id=:uid"),
-        {"v": new_val, "uid": user_id},
-    )
+    await _ensure_user_settings(session)
+    await _ensure_user_settings_row(session, user_id)
+    # Атомарный флип на сервере: не читаем текущее значение отдельно.
+    new_val = (
+        await session.execute(
+            text("update user_settings set delivery_enabled = not delivery_enabled where user_id=:uid returning delivery_enabled"),
+            {"uid": user_id},
+        )
+    ).scalar_one()
     await session.commit()
-    return new_val
+    _settings_cache_invalidate(user_id)
+    return bool(new_val)
 
 
 async def _toggle_format_mode(session, user_id: int) -> str:
-    cur = await _get_user_settings(session, user_id)
-    mode = (cur.get("format_mode") or "digest").strip().lower()
-    new_mode = "compact" if mode != "compact" else "digest"
-    await session.execute(
-        text("update user_settings set format_mode=:m where user_id=:uid"),
-        {"m": new_mode, "uid": user_id},
-    )
+    await _ensure_user_settings(session)
+    await _ensure_user_settings_row(session, user_id)
+    new_mode = (
+        await session.execute(
+            text(
+                "update user_settings set format_mode = "
+                "case when format_mode='compact' then 'digest' else 'compact' end "
+                "where user_id=:uid returning format_mode"
+            ),
+            {"uid": user_id},
+        )
+    ).scalar_one()
     await session.commit()
-    return new_mode
+    _settings_cache_invalidate(user_id)
+    return str(new_mode)
 
 
 async def _set_interval_minutes(session, user_id: int, minutes: int | None) -> None:
@@ -209,11 +491,13 @@ async def _set_interval_minutes(session, user_id: int, minutes: int | None) -> N
     if minutes is None or minutes <= 0:
         await session.execute(text("update user_settings set digest_interval_sec=null where user_id=:uid"), {"uid": user_id})
         await session.commit()
+        _settings_cache_invalidate(user_id)
         return
 
     sec = max(int(minutes) * 60, 60)
     await session.execute(text("update user_settings set digest_interval_sec=:sec where user_id=:uid"), {"sec": sec, "uid": user_id})
     await session.commit()
+    _settings_cache_invalidate(user_id)
 
 
 async def _pause_for_seconds(session, user_id: int, seconds: int) -> None:
@@ -222,6 +506,7 @@ async def _pause_for_seconds(session, user_id: int, seconds: int) -> None:
     await _ensure_user_settings_row(session, user_id)
     await session.execute(text("update user_settings set pause_until=:u where user_id=:uid"), {"u": until, "uid": user_id})
     await session.commit()
+    _settings_cache_invalidate(user_id)
 
 
 async def _pause_clear(session, user_id: int) -> None:
@@ -229,6 +514,7 @@ async def _pause_clear(session, user_id: int) -> None:
     await _ensure_user_settings_row(session, user_id)
     await session.execute(text("update user_settings set pause_until=null where user_id=:uid"), {"uid": user_id})
     await session.commit()
+    _settings_cache_invalidate(user_id)
 
 
 async def _reset_deliveries_for_user(session, user_id: int) -> int:
@@ -243,40 +529,83 @@ async def _touch_last_sent(session, user_id: int) -> None:
     await _ensure_user_settings_row(session, user_id)
     await session.execute(text("update user_settings set last_sent_at=now() where user_id=:uid"), {"uid": user_id})
     await session.commit()
+    _settings_cache_invalidate(user_id)
 
 
-def _fmt_settings(s: dict) -> str:
-    st = "ВКЛ ✅" if s["delivery_enabled"] else "ВЫКЛ ⛔️"
+# Некритичные записи (last_sent_at, позиция меню) уводим с пути ответа
+# пользователю: таска пишет в своей сессии после того, как ответ уже ушёл.
+# Сильные ссылки держим в set — иначе event loop может собрать таску до
+# завершения.
+_bg_tasks: set[asyncio.Task] = set()
+
 
-    if s["digest_interval_sec"]:
-        mins = max(int(s["digest_interval_sec"] // 60), 1)
+def _spawn_bg(coro) -> None:
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+
+
+async def _touch_last_sent_bg(user_id: int) -> None:
+    try:
+        async with session_scope() as session:
+            await _touch_last_sent(session, user_id)
+    except Exception:
+        logger.exception("touch_last_sent bg error")
+
+
+async def _set_menu_message_bg(user_id: int, chat_id: int, message_id: int) -> None:
+    try:
+        async with session_scope() as session:
+            await _set_menu_message(session, user_id, chat_id, message_id)
+    except Exception:
+        logger.exception("set_menu_message bg error")
+
+
+@lru_cache(maxsize=1024)
+def _fmt_settings_cached(enabled: bool, interval_sec, mode_raw, pause: str, last) -> str:
+    st = "ВКЛ ✅" if enabled else "ВЫКЛ ⛔️"
+
+    if interval_sec:
+        mins = max(int(interval_sec // 60), 1)
         iv = f"{mins} мин"
     else:
         iv = "глобальная (env)"
 
-    mode = "компакт" if (s.get("format_mode") == "compact") else "дайджест"
+    mode = "компакт" if (mode_raw == "compact") else "дайджест"
+
+    last_txt = last.isoformat() if last else "-"
+
+    return f"Рассылка: {st}\nИнтервал: {iv}\nФормат: {mode}\nПауза: {pause}\nПоследняя отправка: {last_txt}"
 
-    last = s["last_sent_at"].isoformat() if s["last_sent_at"] else "-"
 
+def _fmt_settings(s: dict) -> str:
+    # Статус паузы зависит от "сейчас" — считаем его снаружи кэша, а чистую
+    # сборку строки мемоизируем по кортежу полей: между кликами настройки
+    # обычно не меняются.
     pause_until = s.get("pause_until")
+    pause = "нет"
     if pause_until:
         try:
             if pause_until.tzinfo is None:
                 pause_until = pause_until.replace(tzinfo=timezone.utc)
             if pause_until > datetime.now(timezone.utc):
                 pause = f"до {pause_until.isoformat(timespec='seconds')}"
-            else:
-                pause = "нет"
         except Exception:
             pause = "нет"
-    else:
-        pause = "нет"
 
-    return f"Рассылка: {st}\nИнтервал: {iv}\nФормат: {mode}\nПауза: {pause}\nПоследняя отправка: {last}"
+    return _fmt_settings_cached(
+        bool(s["delivery_enabled"]),
+        s["digest_interval_sec"],
+        s.get("format_mode"),
+        pause,
+        s["last_sent_at"],
+    )
 
 
-def _kb_menu() -> InlineKeyboardMarkup:
-    rows = [
+# Клавиатуры без параметров — константы: собираем один раз на импорт,
+# а не по 7 кнопок на каждый рендер меню.
+_KB_MENU = InlineKeyboardMarkup(
+    inline_keyboard=[
         [InlineKeyboardButton(text="📦 Паки", callback_data="scr:packs:0")],
         [InlineKeyboardButton(text="🚀 Отправить сейчас", callback_data="scr:send")],
         [InlineKeyboardButton(text="🧾 Очередь", callback_data="scr:queue")],
@@ -285,28 +614,25 @@ def _kb_menu() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="📊 Статистика", callback_data="scr:stats")],
         [InlineKeyboardButton(text="ℹ️ Помощь", callback_data="scr:help")],
     ]
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+)
 
 
-def _kb_back(to: str = "menu") -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data=f"scr:{to}")]])
+def _kb_menu() -> InlineKeyboardMarkup:
+    return _KB_MENU
 
 
-def _kb_settings(s: dict) -> InlineKeyboardMarkup:
-    toggle_txt = "Отключить рассылку" if s["delivery_enabled"] else "Включить рассылку"
+@lru_cache(maxsize=8)
+def _kb_back(to: str = "menu") -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data=f"scr:{to}")]])
 
-    paused = False
-    pu = s.get("pause_until")
-    if pu:
-        try:
-            if pu.tzinfo is None:
-                pu = pu.replace(tzinfo=timezone.utc)
-            paused = pu > datetime.now(timezone.utc)
-        except Exception:
-            paused = False
 
+# Клавиатура настроек имеет всего 8 вариантов (вкл/пауза/формат) — держим
+# готовые объекты, а зависящий от "сейчас" флаг паузы считаем снаружи кэша.
+@lru_cache(maxsize=16)
+def _kb_settings_cached(enabled: bool, paused: bool, compact: bool) -> InlineKeyboardMarkup:
+    toggle_txt = "Отключить рассылку" if enabled else "Включить рассылку"
     pause_txt = "▶️ Возобновить" if paused else "⏸ Пауза 1 час"
-    mode_txt = "Формат: компакт" if (s.get("format_mode") == "compact") else "Формат: дайджест"
+    mode_txt = "Формат: компакт" if compact else "Формат: дайджест"
 
     rows = [
         [InlineKeyboardButton(text=toggle_txt, callback_data="act:delivery_toggle:settings")],
@@ -324,16 +650,35 @@ def _kb_settings(s: dict) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-def _kb_reset_confirm() -> InlineKeyboardMarkup:
-    rows = [
+def _kb_settings(s: dict) -> InlineKeyboardMarkup:
+    paused = False
+    pu = s.get("pause_until")
+    if pu:
+        try:
+            if pu.tzinfo is None:
+                pu = pu.replace(tzinfo=timezone.utc)
+            paused = pu > datetime.now(timezone.utc)
+        except Exception:
+            paused = False
+
+    return _kb_settings_cached(bool(s["delivery_enabled"]), paused, s.get("format_mode") == "compact")
+
+
+_KB_RESET_CONFIRM = InlineKeyboardMarkup(
+    inline_keyboard=[
         [InlineKeyboardButton(text="✅ Да, сбросить", callback_data="act:reset_deliveries")],
         [InlineKeyboardButton(text="⬅️ Отмена", callback_data="scr:settings")],
     ]
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+)
 
 
-def _kb_send(s: dict) -> InlineKeyboardMarkup:
-    mode_txt = "Формат: компакт" if (s.get("format_mode") == "compact") else "Формат: дайджест"
+def _kb_reset_confirm() -> InlineKeyboardMarkup:
+    return _KB_RESET_CONFIRM
+
+
+@lru_cache(maxsize=4)
+def _kb_send_cached(compact: bool) -> InlineKeyboardMarkup:
+    mode_txt = "Формат: компакт" if compact else "Формат: дайджест"
     rows = [
         [InlineKeyboardButton(text=mode_txt, callback_data="act:mode_toggle:send")],
         [
@@ -347,14 +692,31 @@ def _kb_send(s: dict) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-def _kb_help() -> InlineKeyboardMarkup:
-    rows = [
+def _kb_send(s: dict) -> InlineKeyboardMarkup:
+    return _kb_send_cached(s.get("format_mode") == "compact")
+
+
+_KB_HELP = InlineKeyboardMarkup(
+    inline_keyboard=[
         [InlineKeyboardButton(text="⬅️ В меню", callback_data="scr:menu")],
     ]
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+)
+
+
+def _kb_help() -> InlineKeyboardMarkup:
+    return _KB_HELP
 
 
 def _kb_packs(packs: list[PackRow], selected: set[int], page: int, pages: int, delivery_enabled: bool) -> InlineKeyboardMarkup:
+    # Набор паков маленький и стабильный — кэшируем собранную клавиатуру,
+    # чтобы не пересоздавать одни и те же pydantic-объекты на каждый callback.
+    return _kb_packs_cached(tuple(packs), frozenset(selected), page, pages, delivery_enabled)
+
+
+@lru_cache(maxsize=256)
+def _kb_packs_cached(
+    packs: tuple[PackRow, ...], selected: frozenset[int], page: int, pages: int, delivery_enabled: bool
+) -> InlineKeyboardMarkup:
     rows: list[list[InlineKeyboardButton]] = []
     for p in packs:
         mark = "✅" if p.id in selected else "➕"
@@ -375,13 +737,35 @@ def _kb_packs(packs: list[PackRow], selected: set[int], page: int, pages: int, d
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+# (chat_id, message_id) -> дайджест последнего отправленного (text, markup);
+# позволяет не дёргать Telegram API, когда перерисовка ничего не меняет
+# (двойной тап и т.п.). message_id без chat_id не уникален: это счётчик
+# внутри чата, у разных пользователей id совпадают.
+_last_render: dict[tuple[int, int], bytes] = {}
+
+
+def _render_digest(text0: str, kb: InlineKeyboardMarkup) -> bytes:
+    return hashlib.blake2b(repr((text0, kb)).encode("utf-8"), digest_size=8).digest()
+
+
+def _last_render_store(chat_id: int, message_id: int, digest: bytes) -> None:
+    if len(_last_render) > 10_000:
+        _last_render.clear()
+    _last_render[(int(chat_id), int(message_id))] = digest
+
+
 async def _safe_edit_text(cb: CallbackQuery, text0: str, kb: InlineKeyboardMarkup) -> None:
     if not cb.message:
         return
+    key = (int(cb.message.chat.id), int(cb.message.message_id))
+    digest = _render_digest(text0, kb)
+    if _last_render.get(key) == digest:
+        return
     try:
         await cb.message.edit_text(text0, reply_markup=kb)
     except TelegramBadRequest as e:
         if "message is not modified" in str(e):
+            _last_render_store(key[0], key[1], digest)
             return
         try:
             await cb.message.edit_reply_markup(reply_markup=kb)
@@ -389,180 +773,184 @@ async def _safe_edit_text(cb: CallbackQuery, text0: str, kb: InlineKeyboardMarku
             if "message is not modified" in str(e2):
                 return
             raise
+        # Фолбэк обновил только клавиатуру — текст на экране не тот, дайджест не пишем.
+        return
+    _last_render_store(key[0], key[1], digest)
 
 
-async def ensure_user(tg_id: int) -> User:
-    async with session_scope() as session:
-        user = (await session.execute(select(User).where(User.tg_id == tg_id))).scalars().first()
-        if user:
-            await _ensure_user_settings(session)
-            await _ensure_user_settings_row(session, user.id)
-            return user
-        user = User(tg_id=tg_id, role="guest")
-        session.add(user)
-        await session.commit()
-        await session.refresh(user)
-        await _ensure_user_settings(session)
-        await _ensure_user_settings_row(session, user.id)
-        return user
+# tg_id -> User не меняется после создания аккаунта: держим в памяти,
+# чтобы каждый клик не начинался с upsert'а в users.
+_user_cache: dict[int, User] = {}
 
 
-async def _fetch_packs(session) -> list[PackRow]:
-    packs_t, _user_packs_t, _pack_channels_t = await _resolve_pack_tables(session)
-    cols = await _table_cols(session, packs_t)
+async def ensure_user(session, tg_id: int) -> User:
+    cached = _user_cache.get(tg_id)
+    if cached is not None:
+        return cached
+    # Upsert + RETURNING: один RTT вместо select → insert → refresh.
+    stmt = (
+        pg_insert(User)
+        .values(tg_id=tg_id, role="guest")
+        .on_conflict_do_update(index_elements=[User.tg_id], set_={"tg_id": tg_id})
+        .returning(User)
+    )
+    user = (await session.execute(stmt)).scalars().one()
+    await _ensure_user_settings(session)
+    await _ensure_user_settings_row(session, user.id)
+    # Один commit на пользователя и строку настроек.
+    await session.commit()
+    if len(_user_cache) > 10_000:
+        _user_cache.clear()
+    _user_cache[tg_id] = user
+    return user
+
+
+async def _fetch_packs_and_selected(session, user_id: int) -> tuple[list[PackRow], set[int]]:
+    # LEFT JOIN на user_packs отдаёт список паков и отметки выбора одним запросом
+    # вместо пары "_fetch_packs → _selected_pack_ids".
+    ps = await _resolve_pack_schema(session)
+    res = await session.execute(ps.sql_packs_and_selected, {"uid": user_id})
+    packs: list[PackRow] = []
+    selected: set[int] = set()
+    for r in res:
+        pack = PackRow(id=int(r[0]), title=str(r[1]))
+        packs.append(pack)
+        if r[2]:
+            selected.add(pack.id)
+    return packs, selected
+
+
+_PACKS_TTL_SEC = 60.0
+# user_id -> (годен до (monotonic), packs, selected); выбор мутируем локально на toggle.
+_packs_cache: dict[int, tuple[float, list[PackRow], set[int]]] = {}
+
+
+async def _packs_and_selected_cached(session, user_id: int) -> tuple[list[PackRow], set[int]]:
+    ent = _packs_cache.get(user_id)
+    now = time.monotonic()
+    if ent and ent[0] > now:
+        return ent[1], ent[2]
+    packs, selected = await _fetch_packs_and_selected(session, user_id)
+    if len(_packs_cache) > 10_000:
+        _packs_cache.clear()
+    _packs_cache[user_id] = (now + _PACKS_TTL_SEC, packs, selected)
+    return packs, selected
+
+
+def _packs_cache_toggle(user_id: int, pack_id: int) -> None:
+    # После _toggle_pack зеркалим флип в кэше, чтобы не перечитывать
+    # (packs, selected) из БД ради перерисовки клавиатуры.
+    ent = _packs_cache.get(user_id)
+    if not ent:
+        return
+    selected = ent[2]
+    if pack_id in selected:
+        selected.discard(pack_id)
+    else:
+        selected.add(pack_id)
 
-    id_col = "id" if "id" in cols else None
-    if not id_col:
-        raise RuntimeError(f"packs table {packs_t!r} has no id column; cols={sorted(cols)}")
 
-    title_col = "title" if "title" in cols else ("name" if "name" in cols else ("slug" if "slug" in cols else None))
-    if not title_col:
-        title_col = id_col
+# Выбор паков читается на каждом экране, а меняется только через
+# _toggle_pack — короткого TTL достаточно, чтобы снять бурст кликов.
+_SELECTED_TTL_SEC = 5.0
+_selected_cache: dict[int, tuple[float, set[int]]] = {}
 
-    where_sql = ""
-    if "is_active" in cols:
-        where_sql = "where is_active = true"
 
-    sql = f"select {_safe_ident(id_col)} as id, {_safe_ident(title_col)} as title from {_safe_ident(packs_t)} {where_sql} order by {_safe_ident(id_col)}"
-    res = await session.execute(text(sql))
-    rows = res.all()
-    return [PackRow(id=int(r[0]), title=str(r[1])) for r in rows]
+def _selected_cache_invalidate(user_id: int) -> None:
+    _selected_cache.pop(int(user_id), None)
 
 
 async def _selected_pack_ids(session, user_id: int) -> set[int]:
-    _packs_t, user_packs_t, _pack_channels_t = await _resolve_pack_tables(session)
-    cols = await _table_cols(session, user_packs_t)
-
-    user_id_col = "user_id" if "user_id" in cols else None
-    pack_id_col = "pack_id" if "pack_id" in cols else None
-    enabled_col = "is_enabled" if "is_enabled" in cols else ("enabled" if "enabled" in cols else None)
-
-    if not user_id_col or not pack_id_col:
-        raise RuntimeError(f"user_packs table {user_packs_t!r} missing user_id/pack_id; cols={sorted(cols)}")
-
-    where = f"where {_safe_ident(user_id_col)} = :uid"
-    if enabled_col:
-        where += f" and {_safe_ident(enabled_col)} = true"
-
-    sql = f"select {_safe_ident(pack_id_col)} from {_safe_ident(user_packs_t)} {where}"
-    res = await session.execute(text(sql), {"uid": user_id})
-    return {int(r[0]) for r in res.all()}
+    hit = _selected_cache.get(user_id)
+    now = time.monotonic()
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    ps = await _resolve_pack_schema(session)
+    res = await session.execute(ps.sql_selected, {"uid": user_id})
+    out = {int(r[0]) for r in res}
+    if len(_selected_cache) > 10_000:
+        _selected_cache.clear()
+    _selected_cache[user_id] = (now + _SELECTED_TTL_SEC, out)
+    return out
 
 
 async def _toggle_pack(session, user_id: int, pack_id: int) -> None:
-    _packs_t, user_packs_t, _pack_channels_t = await _resolve_pack_tables(session)
-    cols = await _table_cols(session, user_packs_t)
-
-    user_id_col = "user_id" if "user_id" in cols else None
-    pack_id_col = "pack_id" if "pack_id" in cols else None
-    enabled_col = "is_enabled" if "is_enabled" in cols else ("enabled" if "enabled" in cols else None)
-
-    if not user_id_col or not pack_id_col:
-        raise RuntimeError(f"user_packs table {user_packs_t!r} missing user_id/pack_id; cols={sorted(cols)}")
-
-    sql_find = (
-        f"select {_safe_ident(user_id_col)}, {_safe_ident(pack_id_col)}"
-        + (f", {_safe_ident(enabled_col)}" if enabled_col else "")
-        + f" from {_safe_ident(user_packs_t)} where {_safe_ident(user_id_col)}=:uid and {_safe_ident(pack_id_col)}=:pid limit 1"
-    )
-    row = (await session.execute(text(sql_find), {"uid": user_id, "pid": pack_id})).first()
-
-    if enabled_col:
-        if row is None:
-            sql_ins = (
-                f"insert into {_safe_ident(user_packs_t)} ({_safe_ident(user_id_col)}, {_safe_ident(pack_id_col)}, {_safe_ident(enabled_col)}) "
-                f"values (:uid, :pid, true)"
-            )
-            await session.execute(text(sql_ins), {"uid": user_id, "pid": pack_id})
-        else:
-            cur_enabled = bool(row[2])
-            sql_upd = (
-                f"update {_safe_ident(user_packs_t)} set {_safe_ident(enabled_col)} = :val "
-                f"where {_safe_ident(user_id_col)}=:uid and {_safe_ident(pack_id_col)}=:pid"
-            )
-            await session.execute(text(sql_upd), {"val": (not cur_enabled), "uid": user_id, "pid": pack_id})
+    ps = await _resolve_pack_schema(session)
+    if ps.sql_toggle_upsert is not None:
+        # Один upsert вместо select + insert/update: ON CONFLICT переключает флаг.
+        await session.execute(ps.sql_toggle_upsert, {"uid": user_id, "pid": pack_id})
     else:
-        if row is None:
-            sql_ins = (
-                f"insert into {_safe_ident(user_packs_t)} ({_safe_ident(user_id_col)}, {_safe_ident(pack_id_col)}) "
-                f"values (:uid, :pid)"
-            )
-            await session.execute(text(sql_ins), {"uid": user_id, "pid": pack_id})
-        else:
-            sql_del = (
-                f"delete from {_safe_ident(user_packs_t)} where {_safe_ident(user_id_col)}=:uid and {_safe_ident(pack_id_col)}=:pid"
-            )
-            await session.execute(text(sql_del), {"uid": user_id, "pid": pack_id})
+        # Без флага toggle = членство в таблице: CTE удаляет или вставляет
+        # одним statement'ом.
+        await session.execute(ps.sql_member_toggle, {"uid": user_id, "pid": pack_id})
 
     await session.commit()
+    _selected_cache_invalidate(user_id)
 
 
 async def _channels_for_pack_ids(session, pack_ids: list[int]) -> list[str]:
     if not pack_ids:
         return []
-    _packs_t, _user_packs_t, pack_channels_t = await _resolve_pack_tables(session)
-    pc_cols = await _table_cols(session, pack_channels_t)
-
-    pack_id_col = "pack_id" if "pack_id" in pc_cols else None
-    channel_id_col = "channel_id" if "channel_id" in pc_cols else None
-    if not pack_id_col or not channel_id_col:
-        raise RuntimeError(f"pack_channels table {pack_channels_t!r} missing pack_id/channel_id; cols={sorted(pc_cols)}")
-
-    sql = (
-        f"select distinct c.username "
-        f"from {_safe_ident(pack_channels_t)} pc "
-        f"join channels c on c.id = pc.{_safe_ident(channel_id_col)} "
-        f"where pc.{_safe_ident(pack_id_col)} = any(:pids) "
-        f"and c.is_active = true"
-    )
-    res = await session.execute(text(sql), {"pids": pack_ids})
-    usernames = [str(r[0]) for r in res.all()]
-    return [u.lstrip("@") for u in usernames]
+    ps = await _resolve_pack_schema(session)
+    res = await session.execute(ps.sql_channels_for_packs, {"pids": pack_ids})
+    return [str(r[0]) for r in res]
 
 
-async def _fetch_unsent_posts(session, user_id: int, channel_refs: list[str], limit: int) -> list[PostRow]:
+async def _channels_for_user(session, user_id: int) -> list[str]:
+    # Один JOIN вместо пары "_selected_pack_ids → _channels_for_pack_ids":
+    # меньше RTT до Postgres и нет промежуточного списка pack_ids в Python.
+    ps = await _resolve_pack_schema(session)
+    res = await session.execute(ps.sql_channels_for_user, {"uid": user_id})
+    return [str(r[0]) for r in res]
+
+
+async def _fetch_sendable(session, user_id: int, limit: int) -> tuple[str, list[PostRow]]:
+    # Один RTT вместо цепочки "настройки → каналы → посты": если доставка
+    # выключена, активна пауза или нечего слать — просто ноль строк.
+    await _ensure_deliveries_table(session)
+    ps = await _resolve_pack_schema(session)
+    now = datetime.now(timezone.utc)
+    res = await session.execute(ps.sql_sendable, {"uid": user_id, "now": now, "lim": limit})
+    mode = "digest"
+    out: list[PostRow] = []
+    for r in res:
+        mode = str(r[0] or "digest")
+        out.append(PostRow(channel_ref=str(r[1]), message_id=str(r[2]), text=str(r[3] or ""), url=str(r[4] or ""), parsed_at=r[5]))
+    return mode, out
+
+
+async def _count_unsent_posts(session, user_id: int, channel_refs: list[str]) -> int:
     if not channel_refs:
-        return []
+        return 0
     await _ensure_deliveries_table(session)
     now = datetime.now(timezone.utc)
 
-    sql = text(
-        """
-        select p.channel_ref, p.message_id, p.text, p.url, p.parsed_at
-        from posts_cache p
-        left join deliveries d
-          on d.user_id = :uid
-         and d.channel_ref = p.channel_ref
-         and d.message_id = p.message_id
-        where d.id is null
-          and p.is_deleted = false
-          and p.expires_at > :now
-          and p.channel_ref = any(:refs)
-        order by p.parsed_at desc
-        limit :lim
-        """
+    res = await session.execute(
+        _SQL_COUNT_UNSENT,
+        {"uid": user_id, "now": now, "refs": channel_refs, "cap": _UNSENT_COUNT_CAP},
     )
-    res = await session.execute(sql, {"uid": user_id, "now": now, "refs": channel_refs, "lim": limit})
-    out: list[PostRow] = []
-    for r in res.all():
-        out.append(PostRow(channel_ref=str(r[0]), message_id=str(r[1]), text=str(r[2] or ""), url=str(r[3] or ""), parsed_at=r[4]))
-    return out
+    return int(res.scalar_one())
 
 
 async def _mark_delivered(session, user_id: int, posts: list[PostRow]) -> None:
     if not posts:
         return
     await _ensure_deliveries_table(session)
-    rows = [{"uid": user_id, "cr": p.channel_ref, "mid": p.message_id} for p in posts]
+    # Один statement с server-side разворачиванием массивов вместо
+    # executemany: N строк уходит одним сетевым фреймом.
     await session.execute(
         text(
             """
             insert into deliveries (user_id, channel_ref, message_id)
-            values (:uid, :cr, :mid)
+            select :uid, unnest(cast(:crs as text[])), unnest(cast(:mids as text[]))
             on conflict do nothing
             """
         ),
-        rows,
+        {
+            "uid": user_id,
+            "crs": [p.channel_ref for p in posts],
+            "mids": [p.message_id for p in posts],
+        },
     )
     await session.commit()
 
@@ -570,29 +958,40 @@ async def _mark_delivered(session, user_id: int, posts: list[PostRow]) -> None:
 def _build_message(posts: list[PostRow], mode: str) -> str:
     mode = (mode or "digest").strip().lower()
     if mode == "compact":
-        out = "Лента (компакт):\n\n"
+        parts = ["Лента (компакт):\n\n"]
+        total = len(parts[0])
         for p in posts:
             t = (p.text or "").strip().replace("\n", " ")
             if len(t) > 120:
                 t = t[:120] + "…"
             url = (p.url or "").strip() or f"https://t.me/{p.channel_ref}/{p.message_id}"
             line = f"• @{p.channel_ref}: {t}\n{url}\n\n"
-            if len(out) + len(line) > 3800:
+            if total + len(line) > 3800:
                 break
-            out += line
-        return out.strip()
+            parts.append(line)
+            total += len(line)
+        return "".join(parts).strip()
 
-    out = "Авто-дайджест:\n\n"
+    parts = ["Авто-дайджест:\n\n"]
+    total = len(parts[0])
     for p in posts:
         t = (p.text or "").strip().replace("\n", " ")
         if len(t) > 180:
             t = t[:180] + "…"
         url = (p.url or "").strip() or f"https://t.me/{p.channel_ref}/{p.message_id}"
         chunk = f"@{p.channel_ref}: {t}\n{url}\n\n"
-        if len(out) + len(chunk) > 3800:
+        if total + len(chunk) > 3800:
             break
-        out += chunk
-    return out.strip()
+        parts.append(chunk)
+        total += len(chunk)
+    return "".join(parts).strip()
+
+
+async def _settings_snapshot(user_id: int) -> dict:
+    # Настройки в собственной сессии: AsyncSession не переживает конкурентные
+    # await'ы, поэтому для gather каждой ветке — своя сессия из пула engine.
+    async with session_scope() as session:
+        return await _get_user_settings(session, user_id)
 
 
 async def _render_menu(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
@@ -615,93 +1014,105 @@ async def _render_reset_confirm(_user_id: int) -> tuple[str, InlineKeyboardMarku
 
 
 async def _render_send(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
-    async with session_scope() as session:
-        s = await _get_user_settings(session, user_id)
-        selected = await _selected_pack_ids(session, user_id)
-        refs: list[str] = []
-        if selected:
-            refs = await _channels_for_pack_ids(session, list(selected))
-        unsent = 0
-        if refs:
-            unsent = len(await _fetch_unsent_posts(session, user_id, refs, 9999))
-    text0 = "🚀 Отправить сейчас\n\n" + _fmt_settings(s) + f"\n\nВ очереди (тебе): {unsent}\n\nСколько постов отправить?"
+    async def _unsent() -> int:
+        async with session_scope() as session:
+            refs = await _channels_for_user(session, user_id)
+            if not refs:
+                return 0
+            return await _count_unsent_posts(session, user_id, refs)
+
+    # Настройки и очередь независимы: в двух сессиях их ожидания БД
+    # перекрываются, латентность экрана = max, а не сумма.
+    s, unsent = await asyncio.gather(_settings_snapshot(user_id), _unsent())
+    unsent_txt = f"{_UNSENT_COUNT_CAP}+" if unsent >= _UNSENT_COUNT_CAP else str(unsent)
+    text0 = "🚀 Отправить сейчас\n\n" + _fmt_settings(s) + f"\n\nВ очереди (тебе): {unsent_txt}\n\nСколько постов отправить?"
     return text0, _kb_send(s)
 
 
-async def _render_queue(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
-    async with session_scope() as session:
-        s = await _get_user_settings(session, user_id)
-        selected = await _selected_pack_ids(session, user_id)
-        if not selected:
-            return "🧾 Очередь\n\nПаки не выбраны. Сначала выбери /packs.", _kb_back("menu")
+_SQL_QUEUE_STATS = text(
+    """
+    with unsent as (
+        select p.channel_ref, p.message_id, p.text, p.url, p.parsed_at
+        from posts_cache p
+        left join deliveries d
+          on d.user_id = :uid
+         and d.channel_ref = p.channel_ref
+         and d.message_id = p.message_id
+        where d.id is null
+          and p.is_deleted=false
+          and p.expires_at > :now
+          and p.channel_ref = any(:refs)
+    ),
+    agg as (
+        select channel_ref, count(*) as cnt
+        from unsent
+        group by channel_ref
+    ),
+    per as (
+        select channel_ref, cnt, sum(cnt) over () as total,
+               row_number() over (order by cnt desc, channel_ref asc) as ord
+        from agg
+        order by cnt desc, channel_ref asc
+        limit 12
+    ),
+    prev as (
+        select channel_ref, message_id, text, url, parsed_at,
+               row_number() over (order by parsed_at desc) as ord
+        from unsent
+        order by parsed_at desc
+        limit 5
+    )
+    select 'per' as kind, channel_ref, cnt, total,
+           null as message_id, null as text, null as url,
+           null::timestamptz as parsed_at, ord
+    from per
+    union all
+    select 'prev', channel_ref, null, null,
+           message_id, text, url, parsed_at, ord
+    from prev
+    order by kind, ord
+    """
+)
+
+
+async def _queue_stats(session, user_id: int, refs: list[str]) -> tuple[int, list[tuple], list[tuple]]:
+    await _ensure_deliveries_table(session)
+    now = datetime.now(timezone.utc)
 
-        refs = await _channels_for_pack_ids(session, list(selected))
-        if not refs:
-            return "🧾 Очередь\n\nДля выбранных паков нет активных каналов.", _kb_back("menu")
+    # Три почти одинаковых прохода по posts_cache (count, top, preview)
+    # сливаем в один statement: CTE unsent считается один раз, итог
+    # берём оконной суммой, ветки различаем по kind.
+    res = await session.execute(_SQL_QUEUE_STATS, {"uid": user_id, "now": now, "refs": refs})
+    total_unsent = 0
+    per_rows: list[tuple] = []
+    prev_rows: list[tuple] = []
+    for r in res:
+        if r[0] == "per":
+            per_rows.append((r[1], r[2]))
+            total_unsent = int(r[3] or 0)
+        else:
+            prev_rows.append((r[1], r[4], r[5], r[6], r[7]))
+    return total_unsent, per_rows, prev_rows
 
-        await _ensure_deliveries_table(session)
-        now = datetime.now(timezone.utc)
 
-        total_unsent = (await session.execute(
-            text(
-                """
-                select count(*)
-                from posts_cache p
-                left join deliveries d
-                  on d.user_id = :uid
-                 and d.channel_ref = p.channel_ref
-                 and d.message_id = p.message_id
-                where d.id is null
-                  and p.is_deleted=false
-                  and p.expires_at > :now
-                  and p.channel_ref = any(:refs)
-                """
-            ),
-            {"uid": user_id, "now": now, "refs": refs},
-        )).scalar_one()
-
-        per = await session.execute(
-            text(
-                """
-                select p.channel_ref, count(*) as cnt
-                from posts_cache p
-                left join deliveries d
-                  on d.user_id = :uid
-                 and d.channel_ref = p.channel_ref
-                 and d.message_id = p.message_id
-                where d.id is null
-                  and p.is_deleted=false
-                  and p.expires_at > :now
-                  and p.channel_ref = any(:refs)
-                group by p.channel_ref
-                order by cnt desc, p.channel_ref asc
-                limit 12
-                """
-            ),
-            {"uid": user_id, "now": now, "refs": refs},
-        )
-        per_rows = per.all()
+async def _render_queue(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
+    async def _queue_payload():
+        async with session_scope() as session:
+            refs = await _channels_for_user(session, user_id)
+            if not refs:
+                no_packs = not await _selected_pack_ids(session, user_id)
+                return no_packs, None, [], []
+            total_unsent, per_rows, prev_rows = await _queue_stats(session, user_id, refs)
+            return False, total_unsent, per_rows, prev_rows
+
+    s, (no_packs, total_unsent, per_rows, prev_rows) = await asyncio.gather(
+        _settings_snapshot(user_id), _queue_payload()
+    )
+    if total_unsent is None:
+        if no_packs:
+            return "🧾 Очередь\n\nПаки не выбраны. Сначала выбери /packs.", _kb_back("menu")
+        return "🧾 Очередь\n\nДля выбранных паков нет активных каналов.", _kb_back("menu")
 
-        prev = await session.execute(
-            text(
-                """
-                select p.channel_ref, p.message_id, p.text, p.url, p.parsed_at
-                from posts_cache p
-                left join deliveries d
-                  on d.user_id = :uid
-                 and d.channel_ref = p.channel_ref
-                 and d.message_id = p.message_id
-                where d.id is null
-                  and p.is_deleted=false
-                  and p.expires_at > :now
-                  and p.channel_ref = any(:refs)
-                order by p.parsed_at desc
-                limit 5
-                """
-            ),
-            {"uid": user_id, "now": now, "refs": refs},
-        )
-        prev_rows = prev.all()
 
     lines = ["🧾 Очередь", "", _fmt_settings(s), "", f"Всего не доставлено (тебе): {int(total_unsent)}", ""]
     if per_rows:
@@ -728,10 +1139,11 @@ async def _render_queue(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
 
 
 async def _render_packs(user_id: int, page: int) -> tuple[str, InlineKeyboardMarkup]:
-    async with session_scope() as session:
-        s = await _get_user_settings(session, user_id)
-        packs_all = await _fetch_packs(session)
-        selected = await _selected_pack_ids(session, user_id)
+    async def _packs_part() -> tuple[list[PackRow], set[int]]:
+        async with session_scope() as session:
+            return await _packs_and_selected_cached(session, user_id)
+
+    s, (packs_all, selected) = await asyncio.gather(_settings_snapshot(user_id), _packs_part())
 
     per_page = 10
     pages = max((len(packs_all) + per_page - 1) // per_page, 1)
@@ -742,75 +1154,124 @@ async def _render_packs(user_id: int, page: int) -> tuple[str, InlineKeyboardMar
     return text0, _kb_packs(chunk, selected, page, pages, bool(s["delivery_enabled"]))
 
 
+# Тянем только экранные 40 строк (+1 на "есть ещё"); общее число групп
+# отдаёт оконный count, а не материализация всех строк.
+_SQL_CHANNELS_AGG = text(
+    """
+    select channel_ref, cnt, max_mid, count(*) over () as total
+    from (
+        select p.channel_ref, count(*) as cnt, max(p.message_id) as max_mid
+        from unnest(cast(:refs as text[])) r(ref)
+        join posts_cache p
+          on p.channel_ref = r.ref and p.is_deleted = false
+        group by p.channel_ref
+    ) g
+    order by cnt desc, channel_ref asc
+    limit 41
+    """
+)
+
+
 async def _render_channels(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
     async with session_scope() as session:
-        selected = await _selected_pack_ids(session, user_id)
-        if not selected:
-            return "📡 Каналы\n\nПаки не выбраны. Сначала выбери паки.", _kb_back("menu")
-
-        refs = await _channels_for_pack_ids(session, list(selected))
+        refs = await _channels_for_user(session, user_id)
         if not refs:
+            if not await _selected_pack_ids(session, user_id):
+                return "📡 Каналы\n\nПаки не выбраны. Сначала выбери паки.", _kb_back("menu")
             return "📡 Каналы\n\nДля выбранных паков нет активных каналов.", _kb_back("menu")
 
-        sql = text(
-            """
-            select channel_ref, count(*) as cnt, max(message_id) as max_mid
-            from posts_cache
-            where is_deleted=false and channel_ref = any(:refs)
-            group by channel_ref
-            order by cnt desc, channel_ref asc
-            """
-        )
-        res = await session.execute(sql, {"refs": refs})
+        res = await session.execute(_SQL_CHANNELS_AGG, {"refs": refs})
         rows = res.all()
 
+    total = int(rows[0][3]) if rows else 0
     lines = ["📡 Каналы (по выбранным пакам):", ""]
     for r in rows[:40]:
         lines.append(f"@{r[0]} — {int(r[1])} постов (max id {r[2]})")
-    if len(rows) > 40:
+    if total > 40:
         lines.append("")
-        lines.append(f"…и ещё {len(rows)-40}")
+        lines.append(f"…и ещё {total-40}")
 
     return "\n".join(lines).strip(), _kb_back("menu")
 
 
-async def _render_stats(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
-    async with session_scope() as session:
-        s = await _get_user_settings(session, user_id)
-        selected = await _selected_pack_ids(session, user_id)
+_SQL_STATS_UNSENT = text(
+    """
+    select count(*)
+    from posts_cache p
+    where p.is_deleted=false
+      and p.expires_at > now()
+      and not exists (
+        select 1 from deliveries d
+        where d.user_id = :uid
+          and d.channel_ref = p.channel_ref
+          and d.message_id = p.message_id
+      )
+    """
+)
+
+# Глобальные счётчики меняются медленно, а считаются полным сканом —
+# короткий TTL снимает seqscan с каждого клика по "Статистике".
+_STATS_TTL_SEC = 15.0
+_stats_cache: dict[str, tuple[float, int]] = {}
+
+_SQL_STATS_COUNTS = text(
+    """
+    select
+      coalesce((select greatest(reltuples, 0)::bigint from pg_class
+                where relname = 'posts_cache'), 0) as posts_total,
+      coalesce((select greatest(reltuples, 0)::bigint from pg_class
+                where relname = 'deliveries'), 0) as deliveries_total,
+      (select count(*)
+         from posts_cache p
+         where p.is_deleted=false
+           and p.expires_at > now()
+           and not exists (
+             select 1 from deliveries d
+             where d.user_id = :uid
+               and d.channel_ref = p.channel_ref
+               and d.message_id = p.message_id
+           )) as unsent
+    """
+)
 
-        posts_total = (await session.execute(text("select count(*) from posts_cache"))).scalar_one()
-        deliveries_total = (await session.execute(text("select count(*) from deliveries"))).scalar_one()
 
-        unsent = (await session.execute(
-            text(
-                """
-                select count(*)
-                from posts_cache p
-                left join deliveries d
-                  on d.user_id = :uid
-                 and d.channel_ref = p.channel_ref
-                 and d.message_id = p.message_id
-                where d.id is null
-                  and p.is_deleted=false
-                  and p.expires_at > now()
-                """
-            ),
-            {"uid": user_id},
-        )).scalar_one()
+async def _render_stats(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
+    async def _selected_part() -> set[int]:
+        async with session_scope() as session:
+            return await _selected_pack_ids(session, user_id)
+
+    async def _counters() -> tuple[int, int, int]:
+        # Три count(*) одним statement — скалярные подзапросы вместо
+        # трёх последовательных round trip'ов; глобальные итоги при горячем
+        # кэше не пересчитываем, остаётся только персональный unsent.
+        now = time.monotonic()
+        hit_p = _stats_cache.get("posts_total")
+        hit_d = _stats_cache.get("deliveries_total")
+        async with session_scope() as session:
+            if hit_p is not None and hit_d is not None and hit_p[0] > now and hit_d[0] > now:
+                unsent = int((await session.execute(_SQL_STATS_UNSENT, {"uid": user_id})).scalar_one())
+                return hit_p[1], hit_d[1], unsent
+            row = (await session.execute(_SQL_STATS_COUNTS, {"uid": user_id})).one()
+            _stats_cache["posts_total"] = (now + _STATS_TTL_SEC, int(row[0]))
+            _stats_cache["deliveries_total"] = (now + _STATS_TTL_SEC, int(row[1]))
+            return int(row[0]), int(row[1]), int(row[2])
+
+    s, selected, (posts_total, deliveries_total, unsent) = await asyncio.gather(
+        _settings_snapshot(user_id), _selected_part(), _counters()
+    )
 
     text0 = (
         "📊 Статистика\n\n"
         f"{_fmt_settings(s)}\n\n"
         f"Выбрано паков: {len(selected)}\n"
-        f"posts_cache: {int(posts_total)}\n"
-        f"deliveries (все): {int(deliveries_total)}\n"
+        f"posts_cache: ≈ {int(posts_total)}\n"
+        f"deliveries (все): ≈ {int(deliveries_total)}\n"
         f"не доставлено (тебе): {int(unsent)}"
     )
     return text0, _kb_back("menu")
 
 
-async def _render_help() -> tuple[str, InlineKeyboardMarkup]:
+async def _render_help(_user_id: int) -> tuple[str, InlineKeyboardMarkup]:
     text0 = (
         "ℹ️ Помощь\n\n"
         "Команды:\n"
@@ -828,107 +1289,151 @@ async def _render_help() -> tuple[str, InlineKeyboardMarkup]:
     return text0, _kb_help()
 
 
-async def _render_screen(user_id: int, screen: str, page: int = 0) -> tuple[str, InlineKeyboardMarkup]:
-    if screen == "menu":
-        return await _render_menu(user_id)
-    if screen == "settings":
-        return await _render_settings(user_id)
-    if screen == "reset_confirm":
-        return await _render_reset_confirm(user_id)
-    if screen == "send":
-        return await _render_send(user_id)
-    if screen == "queue":
-        return await _render_queue(user_id)
+# Диспатч по словарю вместо лесенки if/elif: один hash-lookup на callback.
+# Все рендереры принимают user_id; страницу знает только packs.
+_RENDERERS: dict[str, object] = {
+    "menu": _render_menu,
+    "settings": _render_settings,
+    "reset_confirm": _render_reset_confirm,
+    "send": _render_send,
+    "queue": _render_queue,
+    "channels": _render_channels,
+    "stats": _render_stats,
+    "help": _render_help,
+}
+
+
+async def _render_screen_now(user_id: int, screen: str, page: int = 0) -> tuple[str, InlineKeyboardMarkup]:
     if screen == "packs":
         return await _render_packs(user_id, page)
-    if screen == "channels":
-        return await _render_channels(user_id)
-    if screen == "stats":
-        return await _render_stats(user_id)
-    if screen == "help":
-        return await _render_help()
-    return await _render_menu(user_id)
+    fn = _RENDERERS.get(screen, _render_menu)
+    return await fn(user_id)
+
+
+# Шквал кликов по пагинации/настройкам порождает рендеры быстрее, чем они
+# успевают закончиться; держим по пользователю только самый свежий.
+_pending_renders: dict[int, asyncio.Task] = {}
+
+
+async def _render_screen(user_id: int, screen: str, page: int = 0) -> tuple[str, InlineKeyboardMarkup]:
+    prev = _pending_renders.get(user_id)
+    if prev is not None and not prev.done():
+        prev.cancel()
+    task = asyncio.create_task(_render_screen_now(user_id, screen, page=page))
+    _pending_renders[user_id] = task
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        # Нас вытеснил более свежий клик: отдаём его результат, а повторный
+        # edit с тем же содержимым отсечёт дайджест в _safe_edit_text.
+        while True:
+            cur = _pending_renders.get(user_id)
+            if cur is None:
+                return await _render_screen_now(user_id, screen, page=page)
+            try:
+                return await cur
+            except asyncio.CancelledError:
+                if not cur.cancelled():
+                    raise
+    finally:
+        if _pending_renders.get(user_id) is task:
+            _pending_renders.pop(user_id, None)
 
 
 async def _send_now(bot: Bot, user_id: int, tg_id: int, n: int) -> int:
     n = max(min(int(n), 50), 1)
+    # Весь гейт (пауза, delivery_enabled, каналы, непрочитанное) — один
+    # запрос; сессию не держим через сетевой вызов к Telegram (сотни
+    # миллисекунд).
     async with session_scope() as session:
-        s = await _get_user_settings(session, user_id)
-
-        pu = s.get("pause_until")
-        if pu:
-            try:
-                if pu.tzinfo is None:
-                    pu = pu.replace(tzinfo=timezone.utc)
-                if pu > datetime.now(timezone.utc):
-                    return 0
-            except Exception:
-                pass
-
-        if not s.get("delivery_enabled", True):
-            return 0
-
-        selected = await _selected_pack_ids(session, user_id)
-        if not selected:
-            return 0
-        refs = await _channels_for_pack_ids(session, list(selected))
-        if not refs:
-            return 0
+        mode, posts = await _fetch_sendable(session, user_id, n)
+    if not posts:
+        return 0
 
-        posts = await _fetch_unsent_posts(session, user_id, refs, n)
-        if not posts:
-            return 0
+    msg = _build_message(posts, mode)
 
-        msg = _build_message(posts, s.get("format_mode") or "digest")
+    await bot.send_message(tg_id, msg)
 
-        await bot.send_message(tg_id, msg)
+    # Отметки о доставке — критичные (иначе повторный клик пришлёт дубли),
+    # ждём их; last_sent_at может догнать в фоне.
+    async with session_scope() as session:
         await _mark_delivered(session, user_id, posts)
-        await _touch_last_sent(session, user_id)
-        return len(posts)
+    _spawn_bg(_touch_last_sent_bg(user_id))
+    return len(posts)
 
 
-async def _open_menu_message(bot: Bot, tg_id: int, chat_id: int, prefer_edit: bool = True) -> None:
-    user = await ensure_user(tg_id)
-    async with session_scope() as session:
+# Позиция меню меняется только когда мы сами шлём новое сообщение: держим
+# (chat_id, message_id) в памяти и ходим в user_settings лишь на холодном
+# старте процесса или после неудачного edit.
+_menu_msg_cache: dict[int, tuple[int, int]] = {}
+
+
+async def _open_menu_message(session, bot: Bot, tg_id: int, chat_id: int, prefer_edit: bool = True) -> None:
+    user = await ensure_user(session, tg_id)
+    loc = _menu_msg_cache.get(user.id)
+    if loc is None:
         s = await _get_user_settings(session, user.id)
-        menu_chat_id = s["menu_chat_id"]
-        menu_message_id = s["menu_message_id"]
+        if s["menu_chat_id"] and s["menu_message_id"]:
+            loc = (int(s["menu_chat_id"]), int(s["menu_message_id"]))
+            _menu_msg_cache[user.id] = loc
 
     text0, kb = await _render_screen(user.id, "menu")
 
-    if prefer_edit and menu_chat_id and menu_message_id and int(menu_chat_id) == int(chat_id):
+    if prefer_edit and loc and loc[0] == int(chat_id):
         try:
-            await bot.edit_message_text(text0, chat_id=int(chat_id), message_id=int(menu_message_id), reply_markup=kb)
+            await bot.edit_message_text(text0, chat_id=loc[0], message_id=loc[1], reply_markup=kb)
+            # Мы отредактировали сообщение мимо _safe_edit_text — дайджест
+            # обязан отразить новое содержимое, иначе следующий callback по
+            # этому сообщению будет ошибочно отсечён как no-op.
+            _last_render_store(loc[0], loc[1], _render_digest(text0, kb))
             return
         except Exception:
-            pass
+            # Сообщение удалили/устарело — кэш врёт, перечитаем после send.
+            _menu_msg_cache.pop(user.id, None)
 
     m = await bot.send_message(chat_id, text0, reply_markup=kb)
-    async with session_scope() as session:
-        await _set_menu_message(session, user.id, int(chat_id), int(m.message_id))
+    if len(_menu_msg_cache) > 10_000:
+        _menu_msg_cache.clear()
+    _menu_msg_cache[user.id] = (int(chat_id), int(m.message_id))
+    _last_render_store(int(chat_id), int(m.message_id), _render_digest(text0, kb))
+    _spawn_bg(_set_menu_message_bg(user.id, int(chat_id), int(m.message_id)))
+
+
+async def _prefetch_packs_bg(user_id: int) -> None:
+    # Спекулятивный прогрев: после /start следующий клик почти всегда
+    # "Паки" — наполняем кэш заранее, пока пользователь смотрит на меню.
+    try:
+        async with session_scope() as session:
+            await _packs_and_selected_cached(session, user_id)
+    except Exception:
+        logger.exception("packs prefetch error")
 
 
 @dp.message(CommandStart())
-async def start(m: Message):
+async def start(m: Message, session):
     logger.info("start tg_id=%s", m.from_user.id)
-    await _open_menu_message(m.bot, m.from_user.id, m.chat.id, prefer_edit=True)
+    user = await ensure_user(session, m.from_user.id)
+    _spawn_bg(_prefetch_packs_bg(user.id))
+    await _open_menu_message(session, m.bot, m.from_user.id, m.chat.id, prefer_edit=True)
 
 
 @dp.message(Command("menu"))
-async def menu_cmd(m: Message):
-    await _open_menu_message(m.bot, m.from_user.id, m.chat.id, prefer_edit=True)
+async def menu_cmd(m: Message, session):
+    await _open_menu_message(session, m.bot, m.from_user.id, m.chat.id, prefer_edit=True)
 
 
 @dp.message(Command("packs"))
-async def packs_cmd(m: Message):
-    user = await ensure_user(m.from_user.id)
+async def packs_cmd(m: Message, session):
+    user = await ensure_user(session, m.from_user.id)
     text0, kb = await _render_screen(user.id, "packs", page=0)
     await m.answer(text0, reply_markup=kb)
 
 
 @dp.message(Command("settings"))
-async def settings_cmd(m: Message):
-    user = await ensure_user(m.from_user.id)
+async def settings_cmd(m: Message, session):
+    user = await ensure_user(session, m.from_user.id)
     text0, kb = await _render_screen(user.id, "settings")
     await m.answer(text0, reply_markup=kb)
 
@@ -939,144 +1444,140 @@ async def noop(cb: CallbackQuery):
 
 
 @dp.callback_query(F.data.startswith("scr:"))
-async def screen_router(cb: CallbackQuery):
-    user = await ensure_user(cb.from_user.id)
-    parts = (cb.data or "").split(":")
+async def screen_router(cb: CallbackQuery, session):
+    user = await ensure_user(session, cb.from_user.id)
+    # maxsplit ограничивает размер списка, _cb_int парсит без исключений.
+    parts = (cb.data or "").split(":", 3)
     screen = parts[1] if len(parts) > 1 else "menu"
-    page = 0
-    if screen == "packs" and len(parts) > 2:
-        try:
-            page = int(parts[2])
-        except Exception:
-            page = 0
+    page = _cb_int(parts[2]) if screen == "packs" and len(parts) > 2 else 0
 
     text0, kb = await _render_screen(user.id, screen, page=page)
-    await _safe_edit_text(cb, text0, kb)
-    await cb.answer("OK")
+    await asyncio.gather(_safe_edit_text(cb, text0, kb), cb.answer("OK"))
 
 
-@dp.callback_query(F.data.startswith("act:"))
-async def action_router(cb: CallbackQuery):
-    user = await ensure_user(cb.from_user.id)
-    parts = (cb.data or "").split(":")
-    act = parts[1] if len(parts) > 1 else ""
-    screen = parts[2] if len(parts) > 2 else "menu"
-    page = 0
-    if len(parts) > 3:
+def _cb_int(s: str | None, default: int = 0) -> int:
+    # int() в try/except дорог именно поднятым исключением на каждом кривом
+    # клике; проверяем цифры заранее и конвертируем без исключений.
+    if not s:
+        return default
+    t = s[1:] if s[0] == "-" else s
+    # isdecimal, не isdigit: isdigit пропускает юникодные цифры ("²"),
+    # на которых int() всё-таки поднимает ValueError.
+    return int(s) if t.isdecimal() else default
+
+
+async def _rerender(cb: CallbackQuery, user_id: int, screen: str, page: int = 0) -> None:
+    text0, kb = await _render_screen(user_id, screen, page=page)
+    # edit и answer — независимые вызовы Telegram: шлём параллельно, не платим
+    # второй RTT последовательно (_safe_edit_text сам гасит BadRequest).
+    await asyncio.gather(_safe_edit_text(cb, text0, kb), cb.answer("OK"))
+
+
+async def _act_delivery_toggle(cb, session, user, screen, page, parts):
+    await _toggle_delivery(session, user.id)
+    await _rerender(cb, user.id, screen, page=page)
+
+
+async def _act_pause_toggle(cb, session, user, screen, page, parts):
+    s = await _get_user_settings(session, user.id)
+    pu = s.get("pause_until")
+    paused = False
+    if pu:
         try:
-            page = int(parts[3])
+            if pu.tzinfo is None:
+                pu = pu.replace(tzinfo=timezone.utc)
+            paused = pu > datetime.now(timezone.utc)
         except Exception:
-            page = 0
+            paused = False
+    if paused:
+        await _pause_clear(session, user.id)
+    else:
+        await _pause_for_seconds(session, user.id, 3600)
+    await _rerender(cb, user.id, screen, page=page)
 
-    if act == "delivery_toggle":
-        async with session_scope() as session:
-            await _toggle_delivery(session, user.id)
-        text0, kb = await _render_screen(user.id, screen, page=page)
-        await _safe_edit_text(cb, text0, kb)
-        await cb.answer("OK")
-        return
 
-    if act == "pause_toggle":
-        async with session_scope() as session:
-            s = await _get_user_settings(session, user.id)
-            pu = s.get("pause_until")
-            paused = False
-            if pu:
-                try:
-                    if pu.tzinfo is None:
-                        pu = pu.replace(tzinfo=timezone.utc)
-                    paused = pu > datetime.now(timezone.utc)
-                except Exception:
-                    paused = False
-            if paused:
-                await _pause_clear(session, user.id)
-            else:
-                await _pause_for_seconds(session, user.id, 3600)
-        text0, kb = await _render_screen(user.id, screen, page=page)
-        await _safe_edit_text(cb, text0, kb)
-        await cb.answer("OK")
-        return
+async def _act_mode_toggle(cb, session, user, screen, page, parts):
+    await _toggle_format_mode(session, user.id)
+    await _rerender(cb, user.id, screen, page=page)
 
-    if act == "mode_toggle":
-        async with session_scope() as session:
-            await _toggle_format_mode(session, user.id)
-        text0, kb = await _render_screen(user.id, screen, page=page)
-        await _safe_edit_text(cb, text0, kb)
-        await cb.answer("OK")
-        return
 
-    if act == "iv":
-        minutes = 0
-        if len(parts) > 2:
-            try:
-                minutes = int(parts[2])
-            except Exception:
-                minutes = 0
-        screen = parts[3] if len(parts) > 3 else "settings"
-        page = 0
-        if len(parts) > 4:
-            try:
-                page = int(parts[4])
-            except Exception:
-                page = 0
-        async with session_scope() as session:
-            await _set_interval_minutes(session, user.id, minutes)
-        text0, kb = await _render_screen(user.id, screen, page=page)
-        await _safe_edit_text(cb, text0, kb)
-        await cb.answer("OK")
-        return
+async def _act_iv(cb, session, user, screen, page, parts):
+    minutes = _cb_int(parts[2]) if len(parts) > 2 else 0
+    screen = parts[3] if len(parts) > 3 else "settings"
+    page = _cb_int(parts[4]) if len(parts) > 4 else 0
+    await _set_interval_minutes(session, user.id, minutes)
+    await _rerender(cb, user.id, screen, page=page)
 
-    if act == "iv_reset":
-        async with session_scope() as session:
-            await _set_interval_minutes(session, user.id, None)
-        text0, kb = await _render_screen(user.id, "settings")
-        await _safe_edit_text(cb, text0, kb)
-        await cb.answer("OK")
-        return
 
-    if act == "pk":
-        pack_id = int(parts[2])
-        page = int(parts[3]) if len(parts) > 3 and parts[3].isdigit() else 0
-        async with session_scope() as session:
-            await _toggle_pack(session, user.id, pack_id)
-        text0, kb = await _render_screen(user.id, "packs", page=page)
-        await _safe_edit_text(cb, text0, kb)
-        await cb.answer("OK")
-        return
+async def _act_iv_reset(cb, session, user, screen, page, parts):
+    await _set_interval_minutes(session, user.id, None)
+    await _rerender(cb, user.id, "settings")
 
-    if act == "reset_deliveries":
-        async with session_scope() as session:
-            n = await _reset_deliveries_for_user(session, user.id)
-        if cb.message:
-            await cb.message.answer(f"Ок. Сброшено доставок: {n}.")
-        text0, kb = await _render_screen(user.id, "settings")
-        await _safe_edit_text(cb, text0, kb)
-        await cb.answer("OK")
+
+async def _act_pk(cb, session, user, screen, page, parts):
+    # pack_id тоже приходит из callback data — парсим без исключений,
+    # кривое значение просто гасим ответом без тоггла.
+    pack_id = _cb_int(parts[2]) if len(parts) > 2 else 0
+    if pack_id <= 0:
+        await cb.answer("")
         return
+    page = _cb_int(parts[3]) if len(parts) > 3 else 0
+    await _toggle_pack(session, user.id, pack_id)
+    _packs_cache_toggle(user.id, pack_id)
+    await _rerender(cb, user.id, "packs", page=page)
 
-    if act == "send":
-        n = 5
-        if len(parts) > 2:
-            try:
-                n = int(parts[2])
-            except Exception:
-                n = 5
-        try:
-            sent = await _send_now(cb.bot, user.id, cb.from_user.id, n)
-            if sent <= 0:
-                await cb.answer("Нечего отправлять", show_alert=False)
-            else:
-                await cb.answer(f"Отправлено: {sent}", show_alert=False)
-        except Exception:
-            logger.exception("send_now error")
-            await cb.answer("Ошибка отправки", show_alert=True)
 
-        # refresh send screen
-        text0, kb = await _render_screen(user.id, "send")
-        await _safe_edit_text(cb, text0, kb)
-        return
+async def _act_reset_deliveries(cb, session, user, screen, page, parts):
+    n = await _reset_deliveries_for_user(session, user.id)
+    if cb.message:
+        await cb.message.answer(f"Ок. Сброшено доставок: {n}.")
+    await _rerender(cb, user.id, "settings")
+
+
+async def _act_send(cb, session, user, screen, page, parts):
+    n = _cb_int(parts[2], 5) if len(parts) > 2 else 5
+    try:
+        sent = await _send_now(cb.bot, user.id, cb.from_user.id, n)
+        if sent <= 0:
+            await cb.answer("Нечего отправлять", show_alert=False)
+        else:
+            await cb.answer(f"Отправлено: {sent}", show_alert=False)
+    except Exception:
+        logger.exception("send_now error")
+        await cb.answer("Ошибка отправки", show_alert=True)
+
+    # refresh send screen
+    text0, kb = await _render_screen(user.id, "send")
+    await _safe_edit_text(cb, text0, kb)
+
+
+# Реестр действий: тот же O(1)-диспатч, что и _RENDERERS, вместо длинной
+# лесенки сравнений в роутере.
+_ACTIONS: dict[str, object] = {
+    "delivery_toggle": _act_delivery_toggle,
+    "pause_toggle": _act_pause_toggle,
+    "mode_toggle": _act_mode_toggle,
+    "iv": _act_iv,
+    "iv_reset": _act_iv_reset,
+    "pk": _act_pk,
+    "reset_deliveries": _act_reset_deliveries,
+    "send": _act_send,
+}
+
 
-    await cb.answer("OK")
+@dp.callback_query(F.data.startswith("act:"))
+async def action_router(cb: CallbackQuery, session):
+    user = await ensure_user(session, cb.from_user.id)
+    parts = (cb.data or "").split(":", 5)
+    act = parts[1] if len(parts) > 1 else ""
+    screen = parts[2] if len(parts) > 2 else "menu"
+    page = _cb_int(parts[3]) if len(parts) > 3 else 0
+
+    handler = _ACTIONS.get(act)
+    if handler is None:
+        await cb.answer("OK")
+        return
+    await handler(cb, session, user, screen, page, parts)
 
 
 async def main() -> None:
@@ -1084,6 +1585,15 @@ async def main() -> None:
         raise SystemExit("BOT_TOKEN is required")
     async with session_scope() as session:
         await maybe_ensure_schema(session)
+        # Прогреваем DDL здесь, чтобы первый callback не платил за create/alter.
+        await _ensure_deliveries_table(session)
+        await _ensure_user_settings(session)
+        # И интроспекцию с готовыми statement'ами: первый пользователь
+        # получает те же кэш-хиты, что и все последующие.
+        try:
+            await _resolve_pack_schema(session)
+        except Exception:
+            logger.exception("pack schema warmup failed; will retry lazily")
 
     bot = Bot(token=BOT_TOKEN)
     await dp.start_polling(bot)
@@ -7,8 +7,6 @@ import re
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple
 
-import httpx
-
 
 def _env_first(*names: str, default: str = "") -> str:
     for n in names:
@@ -107,6 +105,10 @@ async def create_chat_completion(
         payload["response_format"] = response_format
 
     last_err: Optional[Exception] = None
+    # httpx тянем при первом реальном вызове API: при AI_ENABLED=false
+    # процессы не платят за его импорт вовсе.
+    import httpx
+
     async with httpx.AsyncClient(timeout=httpx.Timeout(timeout_sec)) as client:
         for attempt in range(1, retries + 1):
             try:
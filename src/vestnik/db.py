@@ -7,7 +7,30 @@ from sqlalchemy.orm import sessionmaker
 from vestnik.settings import DATABASE_URL
 
 
-engine = create_async_engine(DATABASE_URL, future=True)
+# Пул под конкурентность Telegram-апдейтов: держим соединения открытыми,
+# чтобы не платить за handshake на каждый callback.
+engine = create_async_engine(
+    DATABASE_URL,
+    future=True,
+    pool_size=20,
+    max_overflow=10,
+    # Отлавливаем умершие соединения до выдачи из пула и обновляем их
+    # по расписанию — иначе первый же callback после простоя ловит OperationalError.
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    # Компилированный SQL-кэш с запасом под все statement'ы бота/воркера.
+    query_cache_size=1200,
+    # asyncpg кэширует server-side prepared statements по тексту запроса —
+    # парсинг/планирование коротких горячих запросов уходит из каждого вызова.
+    connect_args={
+        "prepared_statement_cache_size": 256,
+        # Зависший запрос не должен держать соединение пула вечно.
+        "command_timeout": 60,
+        # JIT на коротких OLTP-запросах только добавляет латентность компиляции;
+        # application_name — чтобы находить наши сессии в pg_stat_activity.
+        "server_settings": {"application_name": "vestnik", "jit": "off"},
+    },
+)
 AsyncSessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
 
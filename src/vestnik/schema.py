@@ -228,6 +228,16 @@ async def ensure_schema(session: AsyncSession) -> None:
     await _ensure_column(session, posts_cache_cols, "posts_cache", "created_at", "alter table posts_cache add column created_at timestamptz;")
     await session.execute(text("create index if not exists ix_posts_cache_channel_id on posts_cache(channel_id);"))
     await session.execute(text("create index if not exists ix_posts_cache_message_date on posts_cache(message_date);"))
+    # Частичный индекс под выборку дайджеста (channel_ref = any(...) + order by parsed_at desc):
+    # отдаёт уже отсортированный результат без bitmap scan + top-N sort.
+    # Колонки есть только в "старой" (harvester) форме таблицы — проверяем перед созданием.
+    if {"channel_ref", "parsed_at", "is_deleted"} <= posts_cache_cols:
+        await session.execute(
+            text(
+                "create index if not exists ix_posts_cache_digest "
+                "on posts_cache(channel_ref, parsed_at desc) where is_deleted = false;"
+            )
+        )
 
     # deliveries
     await session.execute(
@@ -256,7 +266,9 @@ async def ensure_schema(session: AsyncSession) -> None:
     await _ensure_column(session, deliveries_cols, "deliveries", "error", "alter table deliveries add column error text;")
     await _ensure_column(session, deliveries_cols, "deliveries", "created_at", "alter table deliveries add column created_at timestamptz;")
 
-    await session.execute(text("create index if not exists ix_deliveries_user_id on deliveries(user_id);"))
+    # ix_deliveries_user_id не создаём: _ensure_deliveries_table в боте/воркере
+    # дропает его как избыточный (анти-join ходит по составному уникальному
+    # индексу), а create здесь означал бы пересборку и дроп на каждом старте.
     await session.execute(text("create index if not exists ix_deliveries_pack_id on deliveries(pack_id);"))
     await session.execute(text("create index if not exists ix_deliveries_status on deliveries(status);"))
 
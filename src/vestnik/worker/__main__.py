@@ -40,31 +40,52 @@ def _env_str(name: str, default: str) -> str:
     return v if v else default
 
 
+_IDENT_RE = re.compile(r"[a-zA-Z0-9_]+")
+
+
 def _safe_ident(name: str) -> str:
-    if not re.fullmatch(r"[a-zA-Z0-9_]+", name or ""):
+    if not _IDENT_RE.fullmatch(name or ""):
         raise ValueError(f"unsafe identifier: {name!r}")
     return name
 
 
-async def _list_tables(session) -> set[str]:
+# Схема в рантайме стабильна — интроспекцию держим в памяти процесса,
+# иначе каждый тик цикла заново ходит в pg_catalog по 3-5 раз. Цикл воркера
+# последовательный, поэтому без лока: гонок за эти переменные нет.
+_tables_cache: frozenset[str] | None = None
+_cols_cache: dict[str, frozenset[str]] = {}
+_pack_tables: tuple[str, str] | None = None
+
+
+async def _list_tables(session) -> frozenset[str]:
+    global _tables_cache
+    if _tables_cache is not None:
+        return _tables_cache
+    # pg_catalog напрямую: information_schema.tables — это view с кучей join'ов.
     q = text(
-        "select table_name from information_schema.tables "
-        "where table_schema='public' and table_type='BASE TABLE'"
+        "select c.relname from pg_class c "
+        "join pg_namespace n on n.oid = c.relnamespace "
+        "where n.nspname = 'public' and c.relkind = 'r'"
     )
     res = await session.execute(q)
-    rows = res.all()
-    out = {r[0] for r in rows}
+    # Без res.all(): не материализуем список Row ради одной проходки.
+    out = frozenset(r[0] for r in res)
     await session.commit()
+    _tables_cache = out
     return out
-async def _table_cols(session, table: str) -> set[str]:
+async def _table_cols(session, table: str) -> frozenset[str]:
+    cached = _cols_cache.get(table)
+    if cached is not None:
+        return cached
     q = text(
-        "select column_name from information_schema.columns "
-        "where table_schema='public' and table_name=:t"
+        "select a.attname from pg_attribute a "
+        "where a.attrelid = to_regclass('public.' || :t) "
+        "and a.attnum > 0 and not a.attisdropped"
     )
     res = await session.execute(q, {"t": table})
-    rows = res.all()
-    out = {r[0] for r in rows}
+    out = frozenset(r[0] for r in res)
     await session.commit()
+    _cols_cache[table] = out
     return out
 def _pick_table(tables: set[str], candidates: list[str]) -> str | None:
     for t in candidates:
@@ -74,6 +95,9 @@ def _pick_table(tables: set[str], candidates: list[str]) -> str | None:
 
 
 async def _resolve_pack_tables(session) -> tuple[str, str]:
+    global _pack_tables
+    if _pack_tables is not None:
+        return _pack_tables
     tables = await _list_tables(session)
 
     user_packs_t = _pick_table(tables, ["user_packs", "user_pack", "users_packs"])
@@ -88,10 +112,21 @@ async def _resolve_pack_tables(session) -> tuple[str, str]:
     if missing:
         raise RuntimeError(f"missing tables: {missing}. existing={sorted(tables)}")
 
-    return user_packs_t, pack_channels_t
+    _pack_tables = (user_packs_t, pack_channels_t)
+    return _pack_tables
+
+
+# DDL идемпотентен, но гонять create/alter на каждом тике (а то и на каждом
+# пользователе) незачем: один прогон на процесс, дальше мгновенный return.
+_deliveries_ready = False
+_report_deliveries_ready = False
+_user_settings_ready = False
 
 
 async def _ensure_deliveries_table(session) -> None:
+    global _deliveries_ready
+    if _deliveries_ready:
+        return
     await session.execute(
         text(
             """
@@ -106,13 +141,20 @@ async def _ensure_deliveries_table(session) -> None:
             """
         )
     )
-    await session.execute(text("create index if not exists ix_deliveries_user_id on deliveries(user_id);"))
+    # unique (user_id, channel_ref, message_id) уже даёт btree-индекс,
+    # которым анти-join ходит по всем трём колонкам; отдельный индекс по
+    # user_id — его префикс и только дублирует запись при insert.
+    await session.execute(text("drop index if exists ix_deliveries_user_id;"))
     await session.execute(text("create index if not exists ix_deliveries_sent_at on deliveries(sent_at);"))
     await session.execute(text("create unique index if not exists ux_deliveries_pair on deliveries(user_id, channel_ref, message_id);"))
     await session.commit()
+    _deliveries_ready = True
 
 
 async def _ensure_report_deliveries_table(session) -> None:
+    global _report_deliveries_ready
+    if _report_deliveries_ready:
+        return
     await session.execute(
         text(
             """
@@ -130,9 +172,13 @@ async def _ensure_report_deliveries_table(session) -> None:
     await session.execute(text("create index if not exists ix_report_deliveries_sent_at on report_deliveries(sent_at);"))
     await session.execute(text("create unique index if not exists ux_report_deliveries_pair on report_deliveries(user_id, report_id);"))
     await session.commit()
+    _report_deliveries_ready = True
 
 
 async def _ensure_user_settings(session) -> None:
+    global _user_settings_ready
+    if _user_settings_ready:
+        return
     await session.execute(
         text(
             """
@@ -153,29 +199,35 @@ async def _ensure_user_settings(session) -> None:
     await session.execute(text("create index if not exists ix_user_settings_delivery_enabled on user_settings(delivery_enabled);"))
     await session.execute(text("create index if not exists ix_user_settings_pause_until on user_settings(pause_until);"))
     await session.commit()
+    _user_settings_ready = True
 
 
 async def _ensure_user_settings_row(session, user_id: int) -> None:
+    # Без собственного commit: вызывающий мутатор коммитит и вставку строки,
+    # и свой UPDATE одной транзакцией — минус round-trip на каждый вызов.
     await session.execute(
         text("insert into user_settings (user_id) values (:uid) on conflict do nothing"),
         {"uid": user_id},
     )
-    await session.commit()
+
+
+# Один round-trip вместо insert+select: do update по PK — no-op, но
+# заставляет RETURNING отдать строку и на конфликте.
+_SQL_SETTINGS_UPSERT = text(
+    """
+    insert into user_settings (user_id) values (:uid)
+    on conflict (user_id) do update set user_id = excluded.user_id
+    returning delivery_enabled, digest_interval_sec, last_sent_at, pause_until, format_mode
+    """
+)
 
 
 async def _get_user_settings(session, user_id: int) -> tuple[bool, int | None, datetime | None, datetime | None, str]:
     await _ensure_user_settings(session)
-    await _ensure_user_settings_row(session, user_id)
-    row = (
-        await session.execute(
-            text("select delivery_enabled, digest_interval_sec, last_sent_at, pause_until, format_mode from user_settings where user_id=:uid"),
-            {"uid": user_id},
-        )
-    ).first()
+    row = (await session.execute(_SQL_SETTINGS_UPSERT, {"uid": user_id})).first()
+    await session.commit()
     if not row:
-        await session.commit()
         return True, None, None, None, "digest"
-    await session.commit()
     return bool(row[0]), (int(row[1]) if row[1] is not None else None), row[2], row[3], (str(row[4]) if row[4] else "digest")
 
 
@@ -215,22 +267,32 @@ async def _fetch_users(session) -> list[UserRow]:
         out.append(UserRow(id=int(r[0]), tg_id=int(r[1])))
     await session.commit()
     return out
+# Разложение колонок статично — f-string SQL и прогон _safe_ident на каждый
+# вызов не нужны: собираем text() один раз и дальше только биндим параметры
+# (заодно один объект statement стабильно попадает в кэш asyncpg).
+_sql_selected_packs = None
+_sql_packs_for_ids: tuple[Any, bool] | None = None
+_sql_channels_for_packs = None
+
+
 async def _selected_pack_ids(session, user_id: int, user_packs_t: str) -> list[int]:
-    cols = await _table_cols(session, user_packs_t)
+    global _sql_selected_packs
+    if _sql_selected_packs is None:
+        cols = await _table_cols(session, user_packs_t)
 
-    user_id_col = "user_id" if "user_id" in cols else None
-    pack_id_col = "pack_id" if "pack_id" in cols else None
-    enabled_col = "is_enabled" if "is_enabled" in cols else ("enabled" if "enabled" in cols else None)
+        user_id_col = "user_id" if "user_id" in cols else None
+        pack_id_col = "pack_id" if "pack_id" in cols else None
+        enabled_col = "is_enabled" if "is_enabled" in cols else ("enabled" if "enabled" in cols else None)
 
-    if not user_id_col or not pack_id_col:
-        raise RuntimeError(f"user_packs table {user_packs_t!r} missing user_id/pack_id; cols={sorted(cols)}")
+        if not user_id_col or not pack_id_col:
+            raise RuntimeError(f"user_packs table {user_packs_t!r} missing user_id/pack_id; cols={sorted(cols)}")
 
-    where = f"where {_safe_ident(user_id_col)} = :uid"
-    if enabled_col:
-        where += f" and {_safe_ident(enabled_col)} = true"
+        where = f"where {_safe_ident(user_id_col)} = :uid"
+        if enabled_col:
+            where += f" and {_safe_ident(enabled_col)} = true"
 
-    sql = f"select {_safe_ident(pack_id_col)} from {_safe_ident(user_packs_t)} {where}"
-    res = await session.execute(text(sql), {"uid": user_id})
+        _sql_selected_packs = text(f"select {_safe_ident(pack_id_col)} from {_safe_ident(user_packs_t)} {where}")
+    res = await session.execute(_sql_selected_packs, {"uid": user_id})
     rows = res.all()
     out = [int(r[0]) for r in rows]
     await session.commit()
@@ -238,30 +300,34 @@ async def _selected_pack_ids(session, user_id: int, user_packs_t: str) -> list[i
 async def _packs_for_ids(session, pack_ids: list[int]) -> list[dict[str, Any]]:
     if not pack_ids:
         return []
-    cols = await _table_cols(session, "packs")
-
-    id_col = "id" if "id" in cols else None
-    key_col = "key" if "key" in cols else ("pack_key" if "pack_key" in cols else ("slug" if "slug" in cols else None))
-    title_col = "title" if "title" in cols else ("name" if "name" in cols else ("pack_name" if "pack_name" in cols else None))
-
-    if not id_col:
-        raise RuntimeError(f"packs table missing id; cols={sorted(cols)}")
-    if not key_col:
-        raise RuntimeError(f"packs table missing key/pack_key/slug; cols={sorted(cols)}")
-
-    sel = f"select {id_col}, {key_col}"
-    if title_col:
-        sel += f", {title_col}"
-    sel += " from packs where id = any(:pids) order by id"
-
-    res = await session.execute(text(sel), {"pids": pack_ids})
+    global _sql_packs_for_ids
+    if _sql_packs_for_ids is None:
+        cols = await _table_cols(session, "packs")
+
+        id_col = "id" if "id" in cols else None
+        key_col = "key" if "key" in cols else ("pack_key" if "pack_key" in cols else ("slug" if "slug" in cols else None))
+        title_col = "title" if "title" in cols else ("name" if "name" in cols else ("pack_name" if "pack_name" in cols else None))
+
+        if not id_col:
+            raise RuntimeError(f"packs table missing id; cols={sorted(cols)}")
+        if not key_col:
+            raise RuntimeError(f"packs table missing key/pack_key/slug; cols={sorted(cols)}")
+
+        sel = f"select {id_col}, {key_col}"
+        if title_col:
+            sel += f", {title_col}"
+        sel += " from packs where id = any(:pids) order by id"
+        _sql_packs_for_ids = (text(sel), title_col is not None)
+
+    stmt, has_title = _sql_packs_for_ids
+    res = await session.execute(stmt, {"pids": pack_ids})
     out: list[dict[str, Any]] = []
     for r in res.all():
         out.append(
             {
                 "id": int(r[0]),
                 "pack_key": str(r[1]),
-                "pack_title": (str(r[2]) if title_col and r[2] is not None else str(r[1])),
+                "pack_title": (str(r[2]) if has_title and r[2] is not None else str(r[1])),
             }
         )
     await session.commit()
@@ -269,53 +335,88 @@ async def _packs_for_ids(session, pack_ids: list[int]) -> list[dict[str, Any]]:
 async def _channels_for_pack_ids(session, pack_ids: list[int], pack_channels_t: str) -> list[str]:
     if not pack_ids:
         return []
-    cols = await _table_cols(session, pack_channels_t)
-
-    pack_id_col = "pack_id" if "pack_id" in cols else None
-    channel_id_col = "channel_id" if "channel_id" in cols else None
-    if not pack_id_col or not channel_id_col:
-        raise RuntimeError(f"pack_channels table {pack_channels_t!r} missing pack_id/channel_id; cols={sorted(cols)}")
-
-    sql = (
-        f"select distinct c.username "
-        f"from {_safe_ident(pack_channels_t)} pc "
-        f"join channels c on c.id = pc.{_safe_ident(channel_id_col)} "
-        f"where pc.{_safe_ident(pack_id_col)} = any(:pids) "
-        f"and c.is_active = true"
-    )
-    res = await session.execute(text(sql), {"pids": pack_ids})
-    usernames = [str(r[0]) for r in res.all()]
+    global _sql_channels_for_packs
+    if _sql_channels_for_packs is None:
+        cols = await _table_cols(session, pack_channels_t)
+
+        pack_id_col = "pack_id" if "pack_id" in cols else None
+        channel_id_col = "channel_id" if "channel_id" in cols else None
+        if not pack_id_col or not channel_id_col:
+            raise RuntimeError(f"pack_channels table {pack_channels_t!r} missing pack_id/channel_id; cols={sorted(cols)}")
+
+        _sql_channels_for_packs = text(
+            f"select distinct ltrim(c.username, '@') "
+            f"from {_safe_ident(pack_channels_t)} pc "
+            f"join channels c on c.id = pc.{_safe_ident(channel_id_col)} "
+            f"where pc.{_safe_ident(pack_id_col)} = any(:pids) "
+            f"and c.is_active = true"
+        )
+    res = await session.execute(_sql_channels_for_packs, {"pids": pack_ids})
+    out = [str(r[0]) for r in res.all()]
     await session.commit()
-    return [u.lstrip("@") for u in usernames]
+    return out
 
 
-async def _fetch_unsent_posts(session, user_id: int, channel_refs: list[str], limit: int) -> list[PostRow]:
-    if not channel_refs:
-        return []
+_sql_unsent_for_user = None
+
+
+async def _fetch_unsent_posts_for_user(
+    session, user_id: int, limit: int, user_packs_t: str, pack_channels_t: str
+) -> list[PostRow]:
+    # Каналы пользователя и непрочитанные посты одним statement'ом: CTE с
+    # join'ом паков вместо промежуточного списка refs в Python — минус один
+    # RTT на каждого пользователя в тике.
+    global _sql_unsent_for_user
+    if _sql_unsent_for_user is None:
+        up_cols = await _table_cols(session, user_packs_t)
+        pc_cols = await _table_cols(session, pack_channels_t)
+
+        user_id_col = "user_id" if "user_id" in up_cols else None
+        up_pack_id_col = "pack_id" if "pack_id" in up_cols else None
+        enabled_col = "is_enabled" if "is_enabled" in up_cols else ("enabled" if "enabled" in up_cols else None)
+        if not user_id_col or not up_pack_id_col:
+            raise RuntimeError(f"user_packs table {user_packs_t!r} missing user_id/pack_id; cols={sorted(up_cols)}")
+
+        pack_id_col = "pack_id" if "pack_id" in pc_cols else None
+        channel_id_col = "channel_id" if "channel_id" in pc_cols else None
+        if not pack_id_col or not channel_id_col:
+            raise RuntimeError(f"pack_channels table {pack_channels_t!r} missing pack_id/channel_id; cols={sorted(pc_cols)}")
+
+        where = f"where up.{_safe_ident(user_id_col)} = :uid"
+        if enabled_col:
+            where += f" and up.{_safe_ident(enabled_col)} = true"
+
+        _sql_unsent_for_user = text(
+            f"with refs as ("
+            f"  select distinct ltrim(c.username, '@') as ref "
+            f"  from {_safe_ident(user_packs_t)} up "
+            f"  join {_safe_ident(pack_channels_t)} pc on pc.{_safe_ident(pack_id_col)} = up.{_safe_ident(up_pack_id_col)} "
+            f"  join channels c on c.id = pc.{_safe_ident(channel_id_col)} "
+            f"  {where} and c.is_active = true"
+            f") "
+            f"select p.channel_ref, p.message_id, left(p.text, 600) as text, p.url "
+            f"from posts_cache p "
+            f"join refs r on r.ref = p.channel_ref "
+            f"where p.is_deleted = false "
+            f"  and p.expires_at > :now "
+            f"  and not exists ("
+            f"    select 1 from deliveries d "
+            f"    where d.user_id = :uid "
+            f"      and d.channel_ref = p.channel_ref "
+            f"      and d.message_id = p.message_id"
+            f"  ) "
+            f"order by p.parsed_at desc "
+            f"limit :lim"
+        )
     now = datetime.now(timezone.utc)
-
-    sql = text(
-        """
-        select p.channel_ref, p.message_id, p.text, p.url
-        from posts_cache p
-        left join deliveries d
-          on d.user_id = :uid
-         and d.channel_ref = p.channel_ref
-         and d.message_id = p.message_id
-        where d.id is null
-          and p.is_deleted = false
-          and p.expires_at > :now
-          and p.channel_ref = any(:refs)
-        order by p.parsed_at desc
-        limit :lim
-        """
-    )
-    res = await session.execute(sql, {"uid": user_id, "now": now, "refs": channel_refs, "lim": limit})
+    res = await session.execute(_sql_unsent_for_user, {"uid": user_id, "now": now, "lim": limit})
     out: list[PostRow] = []
-    for r in res.all():
+    for r in res:
         out.append(PostRow(channel_ref=str(r[0]), message_id=str(r[1]), text=str(r[2] or ""), url=str(r[3] or "")))
     await session.commit()
     return out
+
+
 async def _mark_delivered_posts(session, user_id: int, posts: list[PostRow]) -> None:
     if not posts:
         return
@@ -346,29 +447,33 @@ async def _touch_last_sent(session, user_id: int) -> None:
 def _build_message_posts(posts: list[PostRow], mode: str, max_chars: int = 3800) -> str:
     mode = (mode or "digest").strip().lower()
     if mode == "compact":
-        out = "Лента (компакт):\n\n"
+        parts = ["Лента (компакт):\n\n"]
+        total = len(parts[0])
         for p in posts:
             t = (p.text or "").strip().replace("\n", " ")
             if len(t) > 120:
                 t = t[:120] + "…"
             url = (p.url or "").strip() or f"https://t.me/{p.channel_ref}/{p.message_id}"
             chunk = f"• @{p.channel_ref}: {t}\n{url}\n\n"
-            if len(out) + len(chunk) > max_chars:
+            if total + len(chunk) > max_chars:
                 break
-            out += chunk
-        return out.strip()
+            parts.append(chunk)
+            total += len(chunk)
+        return "".join(parts).strip()
 
-    out = "Авто-дайджест:\n\n"
+    parts = ["Авто-дайджест:\n\n"]
+    total = len(parts[0])
     for p in posts:
         t = (p.text or "").strip().replace("\n", " ")
         if len(t) > 180:
             t = t[:180] + "…"
         url = (p.url or "").strip() or f"https://t.me/{p.channel_ref}/{p.message_id}"
         chunk = f"@{p.channel_ref}: {t}\n{url}\n\n"
-        if len(out) + len(chunk) > max_chars:
+        if total + len(chunk) > max_chars:
             break
-        out += chunk
-    return out.strip()
+        parts.append(chunk)
+        total += len(chunk)
+    return "".join(parts).strip()
 
 
 def _dry_preview_lines_posts(posts: list[PostRow], n: int) -> str:
@@ -597,7 +702,10 @@ async def _oneshot() -> None:
     bot = Bot(token=BOT_TOKEN)
 
     async with session_scope() as session:
+        # Прогреваем DDL до цикла — внутри остаются только мгновенные return'ы.
         await _ensure_user_settings(session)
+        await _ensure_deliveries_table(session)
+        await _ensure_report_deliveries_table(session)
 
         user_packs_t, pack_channels_t = await _resolve_pack_tables(session)
         await _release_read_txn(session)
@@ -744,13 +852,7 @@ async def _oneshot() -> None:
 
                 await _ensure_deliveries_table(session)
 
-                channel_refs = await _channels_for_pack_ids(session, pack_ids, pack_channels_t)
-                await _release_read_txn(session)
-
-                if not channel_refs:
-                    continue
-
-                posts = await _fetch_unsent_posts(session, u.id, channel_refs, max_posts)
+                posts = await _fetch_unsent_posts_for_user(session, u.id, max_posts, user_packs_t, pack_channels_t)
                 await _release_read_txn(session)
 
                 if not posts: